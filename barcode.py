@@ -25,6 +25,8 @@
 import cv2
 import json
 import time
+import threading
+import collections
 import pyzbar.pyzbar as zbar
 import numpy as np
 import qrcode
@@ -32,6 +34,8 @@ from PIL import Image as img
 import os
 import subprocess
 import common
+import wire
+import tracing
 
 
 def get_frame(webcam):
@@ -44,6 +48,353 @@ def get_barcode(frame):
     return zbar.decode(frame)
 
 
+class Decoder():
+    """Find barcodes in a frame without decoding all of it at full size
+
+    Tries, in order, stopping as soon as anything is found:
+
+     1. The region a code was last found in, at full size. Someone holding
+        a card up tends to keep it in about the same place.
+     2. The whole frame, scaled down by `scale`. Cards held close to the
+        camera read fine like this.
+     3. Anything that looks like a QR code in the scaled down frame, cut out
+        of the full size frame. This catches small labels, that are too
+        small to read scaled down, but can still be spotted.
+     4. Every `full_every`th time the rest come up empty, the whole frame at
+        full size, so nothing is missed for long.
+
+    This only pays off behind the frame gate. Without it, every frame of an
+    empty desk goes through each step before falling back to the whole
+    frame, which costs more, and small labels are missed for a few frames.
+    So with the gate off, whole frames are always decoded at full size.
+    """
+    def __init__(self, settings=None, gated=None):
+        """Set up the decoder from the `decoder` setting
+
+        `gated` is whether frames go through the frame gate first, and
+        defaults to whether the `frame_gate` setting has it enabled.
+        """
+        if settings is None:
+            settings = common.SETTINGS["decoder"]
+        if gated is None:
+            gated = common.SETTINGS["frame_gate"]["enabled"]
+        self.enabled = settings["enabled"] and gated
+        self.scale = settings["scale"]
+        self.padding = settings["roi_padding"]
+        self.full_every = settings["full_every"]
+        self.locator = cv2.QRCodeDetector()
+        # Last region a code was found in, as (left, top, right, bottom)
+        self.region = None
+        self.misses = 0
+
+    def __crop__(self, frame, region):
+        """Decode part of a frame, remembering where anything was found"""
+        left, top, right, bottom = region
+        if (right - left < 16) or (bottom - top < 16):
+            return []
+        output = get_barcode(frame[top:bottom, left:right])
+        if output != []:
+            self.__remember__(frame, [each.rect for each in output], left,
+                              top, 1)
+        return output
+
+    def __remember__(self, frame, rects, left, top, scale):
+        """Remember the region covering `rects`, padded a bit
+
+        `rects` are from a part of the frame starting at `left` and `top`,
+        scaled by `scale`.
+        """
+        x1 = min([each.left for each in rects])
+        y1 = min([each.top for each in rects])
+        x2 = max([each.left + each.width for each in rects])
+        y2 = max([each.top + each.height for each in rects])
+        pad_x = (x2 - x1) * self.padding
+        pad_y = (y2 - y1) * self.padding
+        self.misses = 0
+        self.region = (max(int(left + ((x1 - pad_x) / scale)), 0),
+                       max(int(top + ((y1 - pad_y) / scale)), 0),
+                       min(int(left + ((x2 + pad_x) / scale)), frame.shape[1]),
+                       min(int(top + ((y2 + pad_y) / scale)), frame.shape[0]))
+
+    def __candidates__(self, small):
+        """Regions of the full size frame that look like QR codes"""
+        try:
+            found, points = self.locator.detectMulti(small)
+        except cv2.error:
+            return []
+        if not found:
+            return []
+        output = []
+        for each in points:
+            x1, y1 = each.min(axis=0)
+            x2, y2 = each.max(axis=0)
+            pad_x = (x2 - x1) * self.padding
+            pad_y = (y2 - y1) * self.padding
+            output.append((max(int((x1 - pad_x) / self.scale), 0),
+                           max(int((y1 - pad_y) / self.scale), 0),
+                           int((x2 + pad_x) / self.scale) + 1,
+                           int((y2 + pad_y) / self.scale) + 1))
+        return output
+
+    def decode(self, frame):
+        """Get barcodes in frame"""
+        if not self.enabled:
+            return get_barcode(frame)
+        if self.region is not None:
+            output = self.__crop__(frame, self.region)
+            if output != []:
+                return output
+        small = cv2.resize(frame, None, fx=self.scale, fy=self.scale,
+                           interpolation=cv2.INTER_AREA)
+        output = get_barcode(small)
+        if output != []:
+            self.__remember__(frame, [each.rect for each in output], 0, 0,
+                              self.scale)
+            return output
+        for region in self.__candidates__(small):
+            output = self.__crop__(frame, region)
+            if output != []:
+                return output
+        self.region = None
+        self.misses += 1
+        if self.misses >= self.full_every:
+            self.misses = 0
+            output = get_barcode(frame)
+            if output != []:
+                self.__remember__(frame, [each.rect for each in output], 0, 0, 1)
+        return output
+
+
+class Debouncer():
+    """Keep a code that stays in view from being reported over and over
+
+    A card or book left under the webcam is decoded from every frame, so
+    every scan asked for would find it again. Once a code is reported, it
+    isn't again until `ttl` seconds have gone by.
+    """
+    def __init__(self, settings=None):
+        """Set up debouncing from the `scan_dedup` setting"""
+        if settings is None:
+            settings = common.SETTINGS["scan_dedup"]
+        self.enabled = settings["enabled"]
+        self.ttl = settings["ttl"]
+        # Raw data of each code reported lately, and when it was
+        self.reported = {}
+
+    def fresh(self, data, now=None):
+        """Check if a code hasn't been reported lately"""
+        if not self.enabled:
+            return True
+        if now is None:
+            now = time.monotonic()
+        self.reported = {code: at for code, at in self.reported.items()
+                         if now - at < self.ttl}
+        return data not in self.reported
+
+    def report(self, data, now=None):
+        """Note that a code was just reported"""
+        if now is None:
+            now = time.monotonic()
+        self.reported[data] = now
+
+
+class FrameGate():
+    """Decide whether a frame is worth decoding
+
+    Decoding is by far the most expensive part of scanning, and most of
+    the day the camera is looking at an empty desk. So each frame is first
+    shrunk to a thumbnail, by taking every `step`th pixel, and compared
+    with the thumbnail of the last frame that was decoded. If fewer than
+    `min_changed` (a fraction) of its pixels changed by more than
+    `pixel_threshold` grey levels, nothing new is in view, and whatever was
+    found in the last decoded frame still stands.
+
+    Slow changes, like the light shifting over the day, add up against the
+    last decoded frame until they trigger a decode. A frame is also
+    decoded at least every `max_skip` seconds, no matter what.
+    """
+    def __init__(self, settings=None):
+        """Set up the gate from the `frame_gate` setting"""
+        if settings is None:
+            settings = common.SETTINGS["frame_gate"]
+        self.enabled = settings["enabled"]
+        self.step = settings["step"]
+        self.pixel_threshold = settings["pixel_threshold"]
+        self.min_changed = settings["min_changed"]
+        self.max_skip = settings["max_skip"]
+        self.reference = None
+        self.decoded_at = 0
+
+    def changed(self, frame, now=None):
+        """Check if a frame needs decoding
+
+        When it does, it becomes the frame the next ones are compared to.
+        `now` is when the frame was taken, in seconds, and defaults to the
+        current time.
+        """
+        if not self.enabled:
+            return True
+        thumbnail = frame[::self.step, ::self.step].astype(np.int16)
+        if now is None:
+            now = time.monotonic()
+        if ((self.reference is None) or
+                (self.reference.shape != thumbnail.shape) or
+                (now - self.decoded_at >= self.max_skip) or
+                (np.count_nonzero(np.abs(thumbnail - self.reference) > self.pixel_threshold) >
+                 self.min_changed * thumbnail.size)):
+            self.reference = thumbnail
+            self.decoded_at = now
+            return True
+        return False
+
+
+class FrameGrabber():
+    """Read frames from the webcam on a thread of their own
+
+    The webcam holds on to the frames it takes until they are read. So when
+    reading and decoding take turns, and decoding falls behind, each read
+    hands back a frame from a while ago. Instead, this reads every frame as
+    soon as it is taken, into a small ring buffer where newer frames push
+    out older ones. Decoding takes the newest, and drops the rest.
+
+    Most of the day, nobody is waiting on a scan. Once nothing has asked
+    for one in `idle_after` seconds, this idles until `wake()` is called:
+
+     * `slow`: keep the webcam open, but only read `idle_fps` frames a
+       second
+     * `release`: close the webcam entirely. It takes a moment to open
+       again, so the first scan after idling is slower.
+     * null: never idle
+
+    After opening the webcam, the first `warmup_frames` frames are thrown
+    away, while its exposure settles. If it can't be opened or read, it is
+    tried again after `retry` seconds, doubling each time it fails, up to
+    `max_retry`.
+    """
+    def __init__(self, camera=None, settings=None):
+        """Set up capture from a webcam, and the `capture` setting
+
+        `camera` is either what to open with cv2.VideoCapture, like the
+        index of a webcam, or a function that opens one. It defaults to the
+        `camera` setting.
+        """
+        if settings is None:
+            settings = common.SETTINGS["capture"]
+        if camera is None:
+            camera = settings["camera"]
+        self.camera = camera
+        self.idle_mode = settings["idle_mode"]
+        self.idle_after = settings["idle_after"]
+        self.idle_fps = settings["idle_fps"]
+        self.warmup_frames = settings["warmup_frames"]
+        self.retry = settings["retry"]
+        self.max_retry = settings["max_retry"]
+        self.webcam = None
+        # (sequence number, when it was taken, frame), newest last
+        self.frames = collections.deque(maxlen=settings["buffer"])
+        self.ready = threading.Condition()
+        self.woken = threading.Event()
+        self.asked_at = None
+        self.sequence = 0
+        self.dropped = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Start capturing"""
+        self.running = True
+        self.thread = threading.Thread(target=self.__capture__,
+                                       name="PLM-capture", daemon=True)
+        self.thread.start()
+
+    def wake(self):
+        """Note that someone wants a scan, leaving idle if need be"""
+        self.asked_at = time.monotonic()
+        self.woken.set()
+
+    def idle(self):
+        """Check if nobody has asked for a scan in a while"""
+        if self.idle_mode is None:
+            return False
+        return ((self.asked_at is None) or
+                (time.monotonic() - self.asked_at >= self.idle_after))
+
+    def __open__(self):
+        """Open the webcam, and let it warm up"""
+        if callable(self.camera):
+            self.webcam = self.camera()
+        else:
+            self.webcam = cv2.VideoCapture(self.camera)
+        if not self.webcam.isOpened():
+            self.__release__()
+            raise cv2.error("Could not open the webcam")
+        for each in range(self.warmup_frames):
+            self.webcam.read()
+
+    def __release__(self):
+        """Close the webcam, if it's open"""
+        if self.webcam is not None:
+            self.webcam.release()
+            self.webcam = None
+
+    def __capture__(self):
+        """Read frames until stopped"""
+        retry = self.retry
+        while self.running:
+            if self.idle():
+                self.woken.clear()
+                if self.idle_mode == "release":
+                    self.__release__()
+                    self.woken.wait()
+                    continue
+                self.woken.wait(1 / self.idle_fps)
+            try:
+                if self.webcam is None:
+                    self.__open__()
+                frame = get_frame(self.webcam)
+            except cv2.error:
+                print(f"Camera disabled. Trying again in {retry:g}s...")
+                self.__release__()
+                time.sleep(retry)
+                retry = min(retry * 2, self.max_retry)
+                continue
+            retry = self.retry
+            taken_at = time.monotonic()
+            with self.ready:
+                self.sequence += 1
+                if len(self.frames) == self.frames.maxlen:
+                    self.dropped += 1
+                self.frames.append((self.sequence, taken_at, frame))
+                self.ready.notify_all()
+
+    def newest(self, timeout=None, after=None):
+        """Get the newest frame not yet seen, dropping any older ones
+
+        Returns (sequence number, when it was taken, frame), or None if no
+        new frame came in within `timeout` seconds. If `after` is given,
+        only frames taken after then count.
+        """
+        with self.ready:
+            if not self.ready.wait_for(
+                    lambda: ((len(self.frames) > 0) and
+                             ((after is None) or (self.frames[-1][1] > after))),
+                    timeout):
+                return None
+            output = self.frames.pop()
+            self.dropped += len(self.frames)
+            self.frames.clear()
+            return output
+
+    def stop(self):
+        """Stop capturing, and close the webcam"""
+        self.running = False
+        self.woken.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.__release__()
+
+
 def generate_barcode(type, uid):
     """Generate a QR Code"""
     # Generate QR Code
@@ -97,30 +448,64 @@ def print_barcode(paths):
 # this is just a basic barcode scanner that reads in JSON data
 # it has little sanitization, and works in black and white in order to cut
 # down on memory usage.
-def barcode_scanner(pipe, webcam):
-    """Barcode scanner process"""
+def barcode_scanner(pipe, camera=None):
+    """Barcode scanner process
+
+    `camera` is the webcam to scan with, as for `FrameGrabber`.
+    """
     common.set_procname("PLM-barcode")
+    pipe = wire.Channel(pipe)
+    gate = FrameGate()
+    decoder = Decoder()
+    debouncer = Debouncer()
+    capture = FrameGrabber(camera)
+    capture.start()
+    max_age = common.SETTINGS["capture"]["max_age"]
+    wake_timeout = common.SETTINGS["capture"]["wake_timeout"]
     job = False
+    detected_barcodes = []
+    # When the frame `detected_barcodes` came from was taken
+    seen_at = 0
     while True:
-        while True:
-            loop = False
-            try:
-                data = get_frame(webcam)
-            except cv2.error:
-                print("Camera disabled. Sleeping...")
-                time.sleep(1)
-                loop = True
-            if pipe.poll():
-                break
-            if loop:
+        while not pipe.poll():
+            frame = capture.newest(timeout=0.05)
+            if frame is None:
                 continue
-            detected_barcodes = get_barcode(data)
-            if detected_barcodes != []:
-                break
+            sequence, taken_at, data = frame
+            # If nothing changed, what we found last time is still in view
+            if gate.changed(data, taken_at):
+                detected_barcodes = decoder.decode(data)
+            seen_at = taken_at
         if pipe.poll():
-            job = pipe.recv()
-            if job == "get_barcode":
+            request_id, job = pipe.recv()
+            start = tracing.now()
+            if tracing.name_of(job) == "get_barcode":
+                asked_at = time.monotonic()
+                capture.wake()
+                # Unless something was just found, answer from a newer
+                # frame than the last one looked at. Coming out of idle,
+                # that can take a moment. This also keeps the broker, which
+                # asks again straight away when nothing was found, from
+                # asking faster than the webcam takes frames.
+                if (detected_barcodes == []) or (asked_at - seen_at > max_age):
+                    frame = capture.newest(timeout=wake_timeout, after=seen_at)
+                    if frame is None:
+                        # No new frame, so we can't tell what's in view.
+                        # What we saw last could be from long ago, so the
+                        # next frame gets decoded, even if it looks the same.
+                        detected_barcodes = []
+                        gate.reference = None
+                    else:
+                        sequence, seen_at, data = frame
+                        if gate.changed(data, seen_at):
+                            detected_barcodes = decoder.decode(data)
+                # If nothing usable is in view, say so. The broker will ask
+                # again.
+                output = {"type": None, "uid": None}
+                reported = None
                 for barcode in detected_barcodes:
+                    if not debouncer.fresh(barcode.data):
+                        continue
                     data = barcode.data.decode()
                     try:
                         data = json.loads(data)
@@ -131,6 +516,9 @@ def barcode_scanner(pipe, webcam):
                         keys = data.keys()
                         if (("type" in keys) and ("uid" in keys)):
                             output = {"type": data["type"], "uid": data["uid"]}
+                            reported = barcode.data
+                if reported is not None:
+                    debouncer.report(reported)
             elif isinstance(job, dict):
                 print("Abnormal job!")
                 if job["cmd_type"] == "make_qr":
@@ -140,5 +528,8 @@ def barcode_scanner(pipe, webcam):
                 elif job["cmd_type"] == "print_qr":
                     print("Generating images for printing!")
                     output = print_barcode(job["paths"])
-            pipe.send(output)
+            if tracing.trace_of(job) is not None:
+                tracing.span(f"barcode {tracing.name_of(job)}",
+                             tracing.trace_of(job), start, flow="f")
+            pipe.send(request_id, output)
             job = None
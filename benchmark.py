@@ -0,0 +1,701 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  benchmark.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Benchmarks for PyLibMan
+
+Run from the same directory as settings.json:
+
+    python3 benchmark.py checkout [BOOKS] [CYCLES]
+    python3 benchmark.py lookup [LOOKUPS]
+    python3 benchmark.py history [CYCLES]
+    python3 benchmark.py profiles [SECONDS] [READERS]
+    python3 benchmark.py broker [REQUESTS]
+    python3 benchmark.py wire [ROUNDS]
+    python3 benchmark.py pool [SECONDS] [CLIENTS]
+    python3 benchmark.py scanner [VIDEO] [FRAMES]
+    python3 benchmark.py capture [SECONDS] [SLOW_MS]
+    python3 benchmark.py idle [SECONDS] [SCANS]
+    python3 benchmark.py scans [SCANS] [CODES]
+
+The scanner, capture, and idle benchmarks need OpenCV and zbar, and made up
+footage is used if no VIDEO is given.
+"""
+import sys
+import os
+import time
+import random
+import itertools
+import shutil
+import tempfile
+import multiprocessing
+import common
+import broker
+import db
+import schema
+import wire
+
+
+def make_library(path, books, users=1000):
+    """Generate a throwaway library DB with the given number of books and users"""
+    conn = db.connect(path)
+    schema.migrate(conn)
+    status = common.get_template("status")
+    conn.executemany("INSERT INTO books VALUES (?, ?, ?, ?, ?)",
+                     ((uid, f"Book {uid // 5}", "[]", db.__bind__(status),
+                       1900 + (uid % 120)) for uid in range(books)))
+    contact_info = common.get_template("contact_info")
+    conn.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?)",
+                     ((uid, f"User {uid}", db.__bind__(contact_info), "[]",
+                       "user") for uid in range(users)))
+    conn.commit()
+    conn.close()
+
+
+def checkout_cycle(conn, book_uid, user_uid):
+    """Check a book out, then back in, the same way the DB workers do"""
+    for cmd_type in ("checkout", "checkin"):
+        cmd = common.get_template(cmd_type)
+        cmd["data"]["book_uid"] = book_uid
+        cmd["data"]["user_uid"] = user_uid
+        output = db.__circulation_command__(cmd, conn)
+        if output == db.failure:
+            raise RuntimeError(f"{cmd_type} failed for book {book_uid}")
+
+
+def bench_checkout(books=100000, cycles=500):
+    """Checkout/checkin throughput with and without the statement cache"""
+    tmp = tempfile.mkdtemp(prefix="plm-bench-")
+    try:
+        path = os.path.join(tmp, "library.sql")
+        print(f"Generating library with {books} books...")
+        make_library(path, books)
+        # A cache size of 0 makes SQLite re-parse and re-plan every
+        # statement, the way the old f-string commands had to be
+        modes = (("no statement cache", 0),
+                 ("statement cache", common.SETTINGS["statement_cache_size"]))
+        for label, size in modes:
+            common.SETTINGS["statement_cache_size"] = size
+            conn = db.connect(path)
+            uids = random.sample(range(books), cycles)
+            start = time.perf_counter()
+            for each in uids:
+                checkout_cycle(conn, each, each % 1000)
+            elapsed = time.perf_counter() - start
+            conn.close()
+            print(f"{label:>20}: {cycles / elapsed:10.1f} checkout/checkin cycles/sec")
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_lookup(lookups=2000):
+    """Lookup latency by UID and by title as the catalog grows"""
+    tmp = tempfile.mkdtemp(prefix="plm-bench-")
+    try:
+        for books in (1000, 10000, 100000):
+            path = os.path.join(tmp, f"library-{books}.sql")
+            make_library(path, books)
+            conn = db.connect(path)
+            for field in ("uid", "name"):
+                cmd = common.get_template("get")
+                cmd["filter"]["field"] = field
+                start = time.perf_counter()
+                for each in range(lookups):
+                    uid = random.randrange(books)
+                    cmd["filter"]["compare"] = uid if field == "uid" else f"Book {uid // 5}"
+                    db.__get_command__(cmd, "books", conn)
+                elapsed = time.perf_counter() - start
+                print(f"{books:>7} books, by {field:>4}: {elapsed / lookups * 1000000:8.1f} us/lookup")
+            conn.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_history(cycles=5000):
+    """Checkout/checkin cost of one copy as its history grows"""
+    tmp = tempfile.mkdtemp(prefix="plm-bench-")
+    try:
+        path = os.path.join(tmp, "library.sql")
+        make_library(path, 1000)
+        conn = db.connect(path)
+        window = max(cycles // 5, 1)
+        start = time.perf_counter()
+        for each in range(1, cycles + 1):
+            checkout_cycle(conn, 0, 0)
+            if each % window == 0:
+                elapsed = time.perf_counter() - start
+                print(f"after {each:>7} loans: {elapsed / window * 1000000:8.1f} us/cycle")
+                start = time.perf_counter()
+        conn.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def __reader__(path, profile, books, stop, results):
+    """Look up random books until told to stop"""
+    conn = db.connect(path, profile)
+    cmd = common.get_template("get")
+    cmd["filter"]["field"] = "uid"
+    count = 0
+    while not stop.is_set():
+        cmd["filter"]["compare"] = random.randrange(books)
+        db.__get_command__(cmd, "books", conn)
+        count += 1
+    results.put(("read", count))
+
+
+def __writer__(path, profile, books, stop, results):
+    """Check random books out and back in until told to stop"""
+    conn = db.connect(path, profile)
+    count = 0
+    while not stop.is_set():
+        uid = random.randrange(books)
+        checkout_cycle(conn, uid, uid % 1000)
+        count += 1
+    results.put(("write", count))
+
+
+def bench_profiles(seconds=5, readers=3, books=10000):
+    """Mixed read/write throughput under each connection profile"""
+    tmp = tempfile.mkdtemp(prefix="plm-bench-")
+    try:
+        for profile in common.SETTINGS["connection_profiles"]:
+            path = os.path.join(tmp, f"library-{profile}.sql")
+            common.SETTINGS["connection_profile"] = profile
+            make_library(path, books)
+            stop = multiprocessing.Event()
+            results = multiprocessing.Queue()
+            procs = [multiprocessing.Process(target=__writer__,
+                                             args=(path, profile, books, stop, results))]
+            for each in range(readers):
+                procs.append(multiprocessing.Process(target=__reader__,
+                                                     args=(path, profile, books, stop, results)))
+            for each in procs:
+                each.start()
+            time.sleep(seconds)
+            stop.set()
+            totals = {"read": 0, "write": 0}
+            for each in procs:
+                kind, count = results.get()
+                totals[kind] += count
+            for each in procs:
+                each.join()
+            print(f"{profile:>10}: {totals['read'] / seconds:10.1f} reads/sec, {totals['write'] / seconds:8.1f} checkout/checkin cycles/sec")
+    finally:
+        shutil.rmtree(tmp)
+
+
+def start_desk(path, book_readers=0, user_readers=0, scanner=None):
+    """Start the DB workers and broker against a library DB
+
+    Returns the pipe the UI would use, and the processes to clean up.
+    There is no barcode scanner, as no webcam is needed, unless `scanner`
+    is a function to run in place of one, given its pipe.
+    """
+    common.SETTINGS["db_name"] = path
+    procs = []
+    bar_pipe = None
+    if scanner is not None:
+        process, bar_pipe = broker.start_worker(scanner)
+        procs.append(process)
+    process, user_pipe = broker.start_worker(db.user_table)
+    procs.append(process)
+    process, book_pipe = broker.start_worker(db.book_table)
+    procs.append(process)
+    readers = {"users": [], "books": []}
+    for table, count in (("users", user_readers), ("books", book_readers)):
+        for number in range(count):
+            process, reader_pipe = broker.start_worker(db.read_table, table,
+                                                       number)
+            procs.append(process)
+            readers[table].append(reader_pipe)
+    parent_conn4, ui_pipe = multiprocessing.Pipe()
+    procs.append(multiprocessing.Process(target=broker.broker,
+                                         args=(ui_pipe, bar_pipe, user_pipe,
+                                               book_pipe, readers["users"],
+                                               readers["books"])))
+    procs[-1].start()
+    return wire.RequestPipe(parent_conn4), procs
+
+
+def stop_desk(ui_pipe, procs):
+    """Shut down everything started by `start_desk()`"""
+    ui_pipe.send("shut_down")
+    for each in procs:
+        each.terminate()
+    for each in procs:
+        each.join(5)
+        if each.is_alive():
+            each.kill()
+            each.join()
+
+
+def __percentiles__(samples):
+    """Median and 95th percentile of a list of samples, in milliseconds"""
+    samples = sorted(samples)
+    return (samples[len(samples) // 2] * 1000,
+            samples[int(len(samples) * 0.95)] * 1000)
+
+
+def bench_broker(requests=40):
+    """UI request latency through the broker, warm and after sitting idle"""
+    tmp = tempfile.mkdtemp(prefix="plm-bench-")
+    try:
+        path = os.path.join(tmp, "library.sql")
+        make_library(path, 10000)
+        ui_pipe, procs = start_desk(path)
+        cmd = {"table": "users", "command": common.get_template("get")}
+        cmd["command"]["filter"]["field"] = "uid"
+        cmd["command"]["filter"]["compare"] = 1
+        results = {"warm": [], "idle": []}
+        for each in range(requests):
+            for kind in ("warm", "idle"):
+                if kind == "idle":
+                    time.sleep(random.uniform(0.2, 1.0))
+                start = time.perf_counter()
+                ui_pipe.send(cmd)
+                ui_pipe.recv()
+                results[kind].append(time.perf_counter() - start)
+        stop_desk(ui_pipe, procs)
+        for kind, samples in results.items():
+            median, p95 = __percentiles__(samples)
+            print(f"{kind:>5} requests: median {median:7.3f} ms, 95th percentile {p95:7.3f} ms")
+    finally:
+        shutil.rmtree(tmp)
+
+
+def __check_wire__(messages):
+    """Make sure every message survives a round trip in each wire format"""
+    book = common.get_template("db_books")
+    book["check_out_history"] = [common.get_template("check_out_history")]
+    user = common.get_template("db_users")
+    traced = common.get_template("get")
+    traced["trace"] = "0123456789abcdef"
+    cases = list(messages) + [
+        book, # RECORD, holding a LIST of RECORDs
+        [book, user], # LIST of rows with different shapes
+        [[1, 2], [], [3]], # LISTS of scalars
+        [[book], [user, user]], # LISTS of RECORDs
+        {"not": "a template", 1: [book]}, # DICT
+        (1, "two", (3.0, None)), # TUPLE
+        [1, (2, 3), {"x": 4}], [], {}, (), None, True, b"bytes",
+        {"table": "books", "command": traced},
+        "shut_down"]
+    for wire_format in ("pickle", "compact"):
+        encode, decode = wire.__codec__(wire_format)
+        for each in cases:
+            assert decode(encode(each)) == each, (wire_format, each)
+
+
+def bench_wire(rounds=200):
+    """Serialization cost and size of typical messages in each wire format
+
+    Checks first that every format hands back exactly what it was given.
+    Each format is timed for one hop, as the broker passes replies on
+    without decoding them.
+    """
+    checkout = {"table": "both", "command": common.get_template("check_out")}
+    checkout["command"]["data"]["book_uid"] = 123456789
+    checkout["command"]["data"]["user_uid"] = 1000
+    rows = []
+    for uid in range(10000):
+        row = common.get_template("db_books")
+        row["uid"] = uid
+        row["name"] = f"Book {uid // 5}"
+        row["check_out_history"] = []
+        row["check_in_status"] = common.get_template("status")
+        row["published"] = 1900 + (uid % 120)
+        rows.append(row)
+    messages = (("checkout command", checkout, rounds * 100),
+                ("1 row reply", rows[:1], rounds * 100),
+                ("10k row reply", rows, max(rounds // 20, 1)))
+    __check_wire__([body for label, body, count in messages])
+    for label, body, count in messages:
+        for name in ("pickle", "compact"):
+            encode, decode = wire.__codec__(name)
+            start = time.perf_counter()
+            for each in range(count):
+                payload = wire.HEADER.pack(1) + encode(body)
+            encode_time = (time.perf_counter() - start) / count
+            start = time.perf_counter()
+            for each in range(count):
+                decode(payload[wire.HEADER.size:])
+            decode_time = (time.perf_counter() - start) / count
+            print(f"{label:>16}, {name:>7}: {len(payload):8} bytes, encode {encode_time * 1000000:9.1f} us, decode {decode_time * 1000000:9.1f} us")
+
+
+def __read_load__(socket_path, seconds, results):
+    """Send big reads through the broker for a while, counting replies"""
+    common.SETTINGS["broker"]["socket"] = socket_path
+    client = broker.connect()
+    cmd = {"table": "books", "command": common.get_template("get")}
+    cmd["command"]["filter"]["field"] = "published"
+    count = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        cmd["command"]["filter"]["compare"] = random.randint(1900, 2019)
+        client.send(cmd)
+        client.recv()
+        count += 1
+    client.send("shut_down")
+    results.put(count)
+
+
+def bench_pool(seconds=5, clients=4):
+    """Read throughput and checkout latency with each size of read pool
+
+    `clients` processes hammer the book table with reads over the broker's
+    socket, while the UI pipe does checkout and checkin cycles.
+    """
+    tmp = tempfile.mkdtemp(prefix="plm-bench-")
+    try:
+        path = os.path.join(tmp, "library.sql")
+        make_library(path, 50000)
+        common.SETTINGS["broker"]["socket"] = os.path.join(tmp, "broker.sock")
+        common.SETTINGS["catalog_snapshot"]["enabled"] = False
+        for readers in (0, 1, 2, 4):
+            ui_pipe, procs = start_desk(path, book_readers=readers)
+            while not os.path.exists(common.SETTINGS["broker"]["socket"]):
+                time.sleep(0.01)
+            results = multiprocessing.Queue()
+            load = [multiprocessing.Process(target=__read_load__,
+                                            args=(common.SETTINGS["broker"]["socket"],
+                                                  seconds, results))
+                    for each in range(clients)]
+            for each in load:
+                each.start()
+            samples = []
+            end = time.perf_counter() + seconds
+            while time.perf_counter() < end:
+                for kind in ("check_out", "check_in"):
+                    cmd = {"table": "both", "command": common.get_template(kind)}
+                    cmd["command"]["data"]["book_uid"] = 1
+                    cmd["command"]["data"]["user_uid"] = 1
+                    start = time.perf_counter()
+                    ui_pipe.send(cmd)
+                    ui_pipe.recv()
+                    samples.append(time.perf_counter() - start)
+            reads = sum([results.get() for each in load])
+            for each in load:
+                each.join()
+            stop_desk(ui_pipe, procs)
+            median, p95 = __percentiles__(samples)
+            print(f"{readers} readers: {reads / seconds:8.1f} reads/s, "
+                  f"checkout/checkin median {median:7.3f} ms, "
+                  f"95th percentile {p95:7.3f} ms")
+    finally:
+        shutil.rmtree(tmp)
+
+
+def __footage__(path=None, frames=900):
+    """Grayscale frames of recorded footage, and its frame rate
+
+    Without a path, makes up footage of a still desk with sensor noise,
+    where a QR code is held up, moving a little, for a second in every five.
+    Every other time, it's a small label instead of a card.
+    """
+    # Only this benchmark needs these
+    import cv2
+    import numpy as np
+    import qrcode
+    if path is not None:
+        capture = cv2.VideoCapture(path)
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30
+        output = []
+        while len(output) < frames:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            output.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+        capture.release()
+        return output, fps
+    rng = np.random.default_rng(0)
+    desk = cv2.GaussianBlur(rng.integers(60, 200, (480, 640), dtype=np.uint8),
+                            (31, 31), 0)
+    code = np.array(qrcode.make('{"type": "book", "uid": 123456789}').convert("L"),
+                    dtype=np.uint8)
+    codes = [cv2.resize(code, (size, size), interpolation=cv2.INTER_AREA)
+             for size in (200, 110)]
+    output = []
+    for index in range(frames):
+        frame = desk.astype(np.float32)
+        if 60 <= index % 150 < 90:
+            code = codes[(index // 150) % len(codes)]
+            left = 150 + ((index % 150) - 60) * 3
+            frame[140:140 + code.shape[0], left:left + code.shape[1]] = code
+        frame += rng.normal(0, 2, frame.shape)
+        output.append(np.clip(frame, 0, 255).astype(np.uint8))
+    return output, 30
+
+
+def bench_scanner(footage=None, frames=900):
+    """Scanner CPU use, time to decode, and read rate
+
+    Compares decoding whole frames at full size with the `Decoder` pipeline,
+    each with and without the frame gate.
+    """
+    import barcode
+    if isinstance(footage, int):
+        # Only the number of frames was given
+        footage, frames = None, footage
+    frames, fps = __footage__(footage, frames)
+    seen = {}
+    for name, gated in (("full", False), ("full", True),
+                        ("pipeline", False), ("pipeline", True)):
+        settings = dict(common.SETTINGS["frame_gate"])
+        settings["enabled"] = gated
+        gate = barcode.FrameGate(settings)
+        if name == "full":
+            decode = barcode.get_barcode
+        else:
+            decode = barcode.Decoder(gated=gated).decode
+        detected = []
+        decoded = 0
+        decode_time = 0
+        run = f"{name:>8}, gate {'on ' if gated else 'off'}"
+        seen[run] = []
+        start = time.process_time()
+        for index, frame in enumerate(frames):
+            if gate.changed(frame, index / fps):
+                decode_start = time.process_time()
+                detected = decode(frame)
+                decode_time += time.process_time() - decode_start
+                decoded += 1
+            seen[run].append(detected != [])
+        cpu = time.process_time() - start
+        print(f"{run}: decoded {decoded:4}/{len(frames)} frames, "
+              f"{decode_time / max(decoded, 1) * 1000:6.3f} ms per decode, "
+              f"{cpu / len(frames) * fps * 100:5.1f}% of a core at {fps:g} fps")
+    # Take frames where full size decoding of every frame found a code as
+    # the ones with a readable code in view
+    baseline = seen["    full, gate off"]
+    for run, each in seen.items():
+        readable = [index for index, found in enumerate(baseline) if found]
+        if readable == []:
+            print("No codes found in the footage")
+            break
+        read = len([index for index in readable if each[index]])
+        # Time to decode: how long after a code comes into view it is seen
+        delays = []
+        for index in readable:
+            if index == 0 or not baseline[index - 1]:
+                after = index
+                while after < len(frames) and not each[after]:
+                    after += 1
+                delays.append((after - index) / fps * 1000)
+        print(f"{run}: read {read / len(readable) * 100:5.1f}% of frames with a "
+              f"readable code, seen {max(delays):6.1f} ms at worst after it came into view")
+
+
+class __Webcam__():
+    """Plays footage back in real time, the way a webcam hands out frames
+
+    Like a real one, it holds on to the last few frames it took until they
+    are read, dropping the oldest once `buffers` are waiting. The footage
+    starts playing at `started`, or when the first frame is read.
+    """
+    def __init__(self, frames, fps, buffers=4, started=None):
+        import cv2
+        self.frames = [cv2.cvtColor(each, cv2.COLOR_GRAY2BGR) for each in frames]
+        self.fps = fps
+        self.buffers = buffers
+        self.started = started
+        self.next = 0
+        # When each frame read was taken, in order
+        self.taken = []
+
+    def read(self):
+        """Get the oldest frame waiting, or wait for the next one"""
+        if self.started is None:
+            self.started = time.monotonic()
+        newest = int((time.monotonic() - self.started) * self.fps)
+        self.next = max(self.next, newest - self.buffers + 1)
+        taken_at = self.started + (self.next / self.fps)
+        time.sleep(max(taken_at - time.monotonic(), 0))
+        self.taken.append(taken_at)
+        frame = self.frames[self.next % len(self.frames)]
+        self.next += 1
+        return True, frame
+
+    def isOpened(self):
+        """Always open, as in cv2.VideoCapture"""
+        return True
+
+    def release(self):
+        """Nothing to close, as in cv2.VideoCapture"""
+
+
+def bench_capture(seconds=10, slow_ms=40):
+    """Age of the frame behind each scan result, with and without a capture thread
+
+    Decodes every frame at full size, plus `slow_ms` of waiting to stand
+    in for slower hardware than this.
+    """
+    import barcode
+    frames, fps = __footage__(frames=300)
+    settings = dict(common.SETTINGS["capture"])
+    settings["idle_mode"] = None
+    # Every frame read has to be one handed out, to know when it was taken
+    settings["warmup_frames"] = 0
+    for threaded in (False, True):
+        webcam = __Webcam__(frames, fps)
+        capture = barcode.FrameGrabber(lambda: webcam, settings)
+        if threaded:
+            capture.start()
+        ages = []
+        found = 0
+        stop = time.monotonic() + seconds
+        while time.monotonic() < stop:
+            if threaded:
+                sequence, taken_at, frame = capture.newest()
+                taken_at = webcam.taken[sequence - 1]
+            else:
+                frame = barcode.get_frame(webcam)
+                taken_at = webcam.taken[-1]
+            if barcode.get_barcode(frame) != []:
+                found += 1
+            time.sleep(slow_ms / 1000)
+            ages.append(time.monotonic() - taken_at)
+        capture.stop()
+        median, p95 = __percentiles__(ages)
+        print(f"Capture thread {'on ' if threaded else 'off'}: "
+              f"{len(ages) / seconds:5.1f} results/s, {found} with a code, "
+              f"frame behind each result taken {median:6.1f} ms ago "
+              f"(p95 {p95:6.1f} ms), {webcam.next - len(ages)} frames never decoded")
+
+
+def __cpu_time__(pid):
+    """CPU time used by a process so far, in seconds"""
+    with open(f"/proc/{pid}/stat", "r") as file:
+        stat = file.read().rsplit(")", 1)[1].split()
+    return (int(stat[11]) + int(stat[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def bench_idle(seconds=10, scans=5):
+    """Scanner CPU use while idle, and how long the first scan after takes"""
+    import barcode
+    frames, fps = __footage__(frames=300)
+    for mode in (None, "slow", "release"):
+        common.SETTINGS["capture"]["idle_mode"] = mode
+        common.SETTINGS["capture"]["idle_after"] = 1
+        started = time.monotonic()
+        scanner_pipe, bar_pipe = multiprocessing.Pipe()
+        scanner = multiprocessing.Process(
+            target=barcode.barcode_scanner,
+            args=(scanner_pipe, lambda: __Webcam__(frames, fps, started=started)))
+        scanner.start()
+        bar_pipe = wire.Channel(bar_pipe)
+        time.sleep(2)
+        cpu = __cpu_time__(scanner.pid)
+        time.sleep(seconds)
+        cpu = __cpu_time__(scanner.pid) - cpu
+        latencies = []
+        for each in range(scans):
+            # Sit idle, then ask for a scan once a code is in view, the way
+            # the broker does
+            time.sleep(2)
+            ahead = (65 - (((time.monotonic() - started) * fps) % 150)) % 150
+            time.sleep(ahead / fps)
+            asked_at = time.monotonic()
+            while True:
+                bar_pipe.send(0, "get_barcode")
+                if bar_pipe.recv()[1]["uid"] is not None:
+                    break
+            latencies.append(time.monotonic() - asked_at)
+        scanner.terminate()
+        scanner.join()
+        median, p95 = __percentiles__(latencies)
+        print(f"Idle mode {str(mode):>7}: {cpu / seconds * 100:5.1f}% of a core while idle, "
+              f"first scan after idling takes {median:6.1f} ms (worst {max(latencies) * 1000:6.1f} ms)")
+
+
+def __scans__(pipe, codes):
+    """Stand in for the scanner, answering each scan with the next code"""
+    pipe = wire.Channel(pipe)
+    for each in itertools.cycle(codes):
+        request_id, job = pipe.recv()
+        pipe.send(request_id, each)
+
+
+def bench_scans(scans=500, codes=20):
+    """Scan latency, and DB lookups made, with and without the scan cache
+
+    Scans cycle through a few library cards and books, with one of those
+    books checked out to one of those cards, or back in, after every tenth
+    scan.
+    """
+    tmp = tempfile.mkdtemp(prefix="plm-bench-")
+    try:
+        path = os.path.join(tmp, "library.sql")
+        make_library(path, 10000)
+        shown = [{"type": ("user", "book")[each % 2], "uid": random.randint(1, 1000)}
+                 for each in range(codes)]
+        users = [each["uid"] for each in shown if each["type"] == "user"]
+        books = [each["uid"] for each in shown if each["type"] == "book"]
+        for size in (0, 256):
+            common.SETTINGS["broker"]["scan_cache_size"] = size
+            ui_pipe, procs = start_desk(
+                path, scanner=lambda pipe: __scans__(pipe, shown))
+            latencies = []
+            for each in range(scans):
+                start = time.perf_counter()
+                ui_pipe.send("get_barcode")
+                ui_pipe.recv()
+                latencies.append(time.perf_counter() - start)
+                if each % 10 == 9:
+                    circulate = common.get_template(random.choice(("checkout", "checkin")))
+                    circulate["data"]["book_uid"] = random.choice(books)
+                    circulate["data"]["user_uid"] = random.choice(users)
+                    ui_pipe.send({"table": "both", "command": circulate})
+                    ui_pipe.recv()
+            ui_pipe.send("status")
+            commands = ui_pipe.recv()["metrics"]["commands"]
+            stop_desk(ui_pipe, procs)
+            lookups = sum([commands.get(table, {}).get("get", {}).get("count", 0)
+                           for table in ("users", "books")])
+            median, p95 = __percentiles__(latencies)
+            print(f"Scan cache of {size:3}: median {median:7.3f} ms, 95th percentile "
+                  f"{p95:7.3f} ms, {lookups} DB lookups for {scans} scans")
+    finally:
+        shutil.rmtree(tmp)
+
+
+BENCHMARKS = {"checkout": bench_checkout,
+              "lookup": bench_lookup,
+              "history": bench_history,
+              "profiles": bench_profiles,
+              "broker": bench_broker,
+              "wire": bench_wire,
+              "pool": bench_pool,
+              "scanner": bench_scanner,
+              "capture": bench_capture,
+              "idle": bench_idle,
+              "scans": bench_scans}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        common.eprint(__doc__)
+        common.eprint(f"Available benchmarks: {', '.join(BENCHMARKS)}")
+        sys.exit(2)
+    BENCHMARKS[sys.argv[1]](*[int(each) if each.isdigit() else each
+                              for each in sys.argv[2:]])
@@ -0,0 +1,730 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  broker.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Request broker for PyLibMan
+
+The broker is an asyncio service. Each worker process, and each client
+(the UI, or any terminal attached over the broker's Unix or TCP socket),
+is a stream the broker reads from without blocking on any other.
+"""
+import asyncio
+import collections
+import os
+import signal
+import multiprocessing
+import multiprocessing.connection
+import common
+import metrics
+import tracing
+import wire
+
+
+def qr_query(request):
+    """Make a request from QR Code data"""
+    get = common.get_template("get")
+    get["filter"]["field"] = "uid"
+    get["filter"]["compare"] = request["uid"]
+    return get
+
+
+def start_worker(target, *args):
+    """Start a worker process, with a pipe to it as its first argument
+
+    Only the worker keeps its end of the pipe open, so if it dies, our end
+    sees EOF, instead of waiting on replies that never come. Returns the
+    process, and our end of the pipe.
+    """
+    ours, theirs = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=target, args=(theirs,) + args)
+    process.start()
+    theirs.close()
+    return process, ours
+
+
+def __failure__(reason):
+    """Reply for a request the broker couldn't get an answer to"""
+    return {"status": 0, "reason": reason}
+
+
+def __writes__(command):
+    """Check if a command could write to the DB"""
+    return ((not isinstance(command, dict)) or
+            str(command.get("cmd_type")).lower() != "get")
+
+
+def __circulates__(command):
+    """Check if a command checks a book in or out, or renews one, on its
+    own or as part of a batch
+    """
+    if not isinstance(command, dict):
+        return False
+    cmd_type = str(command.get("cmd_type")).lower()
+    if cmd_type == "batch":
+        commands = command.get("commands")
+        return isinstance(commands, list) and any(map(__circulates__, commands))
+    return cmd_type in ("checkout", "checkin", "renew")
+
+
+def __written_uids__(command):
+    """UIDs of the only records a command writes to, or None if it could
+    write to any
+    """
+    if not isinstance(command, dict):
+        return None
+    if str(command.get("cmd_type")).lower() == "batch":
+        if not isinstance(command.get("commands"), list):
+            return None
+        output = set()
+        for each in command["commands"]:
+            if not __writes__(each):
+                continue
+            uids = __written_uids__(each)
+            if uids is None:
+                return None
+            output |= uids
+        return output
+    if __circulates__(command):
+        try:
+            return {str(command["data"]["book_uid"]),
+                    str(command["data"]["user_uid"])}
+        except (KeyError, TypeError):
+            pass
+    return None
+
+
+class Worker():
+    """A worker process, as seen from the broker
+
+    Only so many requests may be waiting on a worker at once. Past that,
+    requests queue up here, with a queue for each client, and clients take
+    turns getting one sent on. That way a terminal sending lots of requests
+    can't starve the others. Requests that get no reply in time are
+    answered with a failure, and the late reply, if one ever comes, is
+    dropped.
+    """
+    def __init__(self, channel, timeout=None, max_in_flight=2):
+        """Set up talking to a worker over a `StreamChannel`"""
+        self.channel = channel
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        # What to do with the reply to each request sent, by request ID
+        self.pending = {}
+        # Requests not sent yet, by client, in the order they get a turn
+        self.queues = collections.OrderedDict()
+        self.queued = 0
+        self.next_id = 0
+        self.alive = True
+
+    def load(self):
+        """How many requests are waiting on this worker"""
+        return len(self.pending) + self.queued
+
+    def send(self, body, handler, client=None, stats=None, trace=None):
+        """Queue up a request, and remember what to do with the reply
+
+        Handlers are coroutines, given the reply still encoded, so they
+        only decode it if they need to look inside. How long the request
+        spends queued and with the worker is recorded in `stats`, if given,
+        and as spans of `trace`, if given.
+        """
+        if not self.alive:
+            if stats is not None:
+                stats.failures += 1
+            asyncio.ensure_future(handler(self.channel.encode_raw(__failure__("worker_exited"))))
+            return
+        if client not in self.queues:
+            self.queues[client] = collections.deque()
+        queued_at = None
+        if (stats is not None) or (trace is not None):
+            queued_at = tracing.now()
+        self.queues[client].append((body, handler, stats, trace, queued_at))
+        self.queued += 1
+        self.__pump__()
+
+    def __pump__(self):
+        """Send queued requests while the worker has room, a client at a time"""
+        loop = asyncio.get_running_loop()
+        while self.queues and (len(self.pending) < self.max_in_flight):
+            client, queue = next(iter(self.queues.items()))
+            body, handler, stats, trace, queued_at = queue.popleft()
+            self.queued -= 1
+            if queue:
+                # Back of the line
+                self.queues.move_to_end(client)
+            else:
+                del self.queues[client]
+            self.next_id += 1
+            timer = None
+            if self.timeout is not None:
+                timer = loop.call_later(self.timeout, self.__expire__,
+                                        self.next_id)
+            sent_at = None
+            if queued_at is not None:
+                sent_at = tracing.now()
+            if stats is not None:
+                stats.queue.record((sent_at - queued_at) / 1000000)
+            if trace is not None:
+                tracing.span("queued", trace, queued_at, sent_at, tid=trace)
+            self.pending[self.next_id] = (handler, timer, stats, trace, sent_at)
+            # No need to wait on the worker, as `max_in_flight` bounds how
+            # much we buffer for it
+            self.channel.write_raw(self.next_id, self.channel.encode_raw(body))
+
+    def __expire__(self, request_id):
+        """Give up on a request"""
+        handler, timer, stats, trace, sent_at = self.pending.pop(request_id)
+        if stats is not None:
+            stats.timeouts += 1
+        if trace is not None:
+            tracing.span("worker (timed out)", trace, sent_at, tid=trace)
+        # The worker is likely still busy with it, but holding its slot
+        # forever would wedge everything else
+        self.__pump__()
+        asyncio.ensure_future(handler(self.channel.encode_raw(__failure__("timeout"))))
+
+    async def run(self):
+        """Hand replies from the worker to their handlers"""
+        while True:
+            try:
+                reply_id, payload = await self.channel.recv_raw()
+            except EOFError:
+                break
+            if reply_id not in self.pending:
+                # Already timed out
+                continue
+            handler, timer, stats, trace, sent_at = self.pending.pop(reply_id)
+            if timer is not None:
+                timer.cancel()
+            if sent_at is not None:
+                replied_at = tracing.now()
+                if stats is not None:
+                    stats.worker.record((replied_at - sent_at) / 1000000)
+                if trace is not None:
+                    tracing.span("worker", trace, sent_at, replied_at, tid=trace)
+            self.__pump__()
+            await handler(payload)
+        self.alive = False
+        failure = self.channel.encode_raw(__failure__("worker_exited"))
+        handlers = []
+        for handler, timer, stats, trace, sent_at in self.pending.values():
+            if timer is not None:
+                timer.cancel()
+            handlers.append((handler, stats))
+        for queue in self.queues.values():
+            handlers.extend([(each[1], each[2]) for each in queue])
+        self.pending.clear()
+        self.queues.clear()
+        self.queued = 0
+        for handler, stats in handlers:
+            if stats is not None:
+                stats.failures += 1
+            await handler(failure)
+
+
+class Pool():
+    """A table's writer, and any read only workers alongside it
+
+    Reads go to whichever reader has the fewest requests waiting on it.
+    Everything else goes to the writer.
+    """
+    def __init__(self, writer, readers=()):
+        """Set up a pool from its `Worker`s"""
+        self.writer = writer
+        self.readers = list(readers)
+
+    def workers(self):
+        """Every worker in the pool"""
+        return [self.writer] + self.readers
+
+    def pick(self, command):
+        """Get the worker to send a command to"""
+        if __writes__(command):
+            return self.writer
+        readers = [each for each in self.readers if each.alive]
+        if readers == []:
+            return self.writer
+        return min(readers, key=Worker.load)
+
+
+class PendingWrites():
+    """Writes a client has waiting on a reply, so its reads can see them
+
+    A read of a table the client has a write waiting on goes to that
+    table's writer, behind the write, instead of to a reader. But a write
+    can touch a table without being run by its writer: circulation is done
+    by the book writer, but changes users too. Reads of users can't go to
+    the book writer, so they are held back until the write is done.
+    """
+    def __init__(self):
+        """Set up with no writes waiting"""
+        # Pool -> workers running writes that touch it, and how many each
+        self.workers = collections.defaultdict(collections.Counter)
+        # Reads held back, to send again once a write is done
+        self.held = []
+
+    def running(self, pool):
+        """Workers with writes waiting that touch a pool"""
+        return [worker for worker, count in self.workers[pool].items()
+                if count > 0]
+
+    def add(self, touches, worker):
+        """Note a write, touching some pools, was sent to `worker`"""
+        for each in touches:
+            self.workers[each][worker] += 1
+
+    def done(self, touches, worker):
+        """Note a write is done, and send on any reads held back"""
+        for each in touches:
+            self.workers[each][worker] -= 1
+        held = self.held
+        self.held = []
+        for send in held:
+            send()
+
+
+class ScanCache():
+    """Replies to looking up recently scanned codes
+
+    A code scanned again, like a library card shown for every book checked
+    out, is answered from here instead of the DB. Up to `size` lookups are
+    kept, dropping the least recently used first. Each write drops what's
+    kept for the records it could touch. A lookup that was
+    waiting on a reply while a write started or finished isn't kept, as it
+    may have read from before the write.
+    """
+    def __init__(self, size):
+        """Set up a cache of `size` lookups"""
+        self.size = size
+        # (pool, UID as a string) -> raw reply
+        self.entries = collections.OrderedDict()
+        # Bumped for a pool whenever a write to it starts or finishes
+        self.generations = collections.Counter()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, pool, uid):
+        """Get the reply to looking up a UID, or None if it isn't kept"""
+        key = (pool, str(uid))
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def generation(self, pool):
+        """Which writes to a pool lookups sent now come after"""
+        return self.generations[pool]
+
+    def put(self, pool, uid, payload, generation):
+        """Keep the reply to a lookup sent at `generation`"""
+        if self.generations[pool] != generation:
+            return
+        key = (pool, str(uid))
+        self.entries[key] = payload
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, pools, uids=None):
+        """Drop what's kept for some UIDs, as strings, or by default every
+        UID, in some pools
+        """
+        for each in pools:
+            self.generations[each] += 1
+        for key in [each for each in self.entries
+                    if (each[0] in pools) and ((uids is None) or (each[1] in uids))]:
+            del self.entries[key]
+
+    def report(self):
+        """How well the cache is doing"""
+        return {"size": len(self.entries), "hits": self.hits,
+                "misses": self.misses}
+
+
+class Broker():
+    """Route requests from clients to the workers, and replies back
+
+    Every message carries a request ID. Requests are handed to the workers
+    as soon as they come in, without waiting on earlier ones, and each
+    reply is routed back by its ID. That way a scan waiting on the webcam
+    never holds up a catalog lookup.
+
+    In server mode there is no barcode scanner, as each terminal scans
+    codes on its own, and `bar_pipe` is None.
+    """
+    def __init__(self, bar_pipe, user_pipe, book_pipe, settings=None,
+                 user_readers=(), book_readers=()):
+        """Set up routing between `StreamChannel`s to each worker"""
+        if settings is None:
+            settings = common.SETTINGS["broker"]
+        self.settings = settings
+        timeout = settings["request_timeout"]
+        in_flight = settings["max_in_flight"]
+        # Getting a barcode waits on someone to scan one, so can take as
+        # long as it likes
+        self.bar_pipe = None
+        if bar_pipe is not None:
+            self.bar_pipe = Pool(Worker(bar_pipe, None, in_flight))
+        self.user_pipe = Pool(Worker(user_pipe, timeout, in_flight),
+                              [Worker(each, timeout, in_flight)
+                               for each in user_readers])
+        self.book_pipe = Pool(Worker(book_pipe, timeout, in_flight),
+                              [Worker(each, timeout, in_flight)
+                               for each in book_readers])
+        self.metrics = None
+        if common.SETTINGS["metrics"]["enabled"]:
+            self.metrics = metrics.Metrics()
+        self.scans = None
+        if settings["scan_cache_size"] > 0:
+            self.scans = ScanCache(settings["scan_cache_size"])
+        self.stopped = asyncio.Event()
+
+    def workers(self):
+        """Every worker we route to"""
+        output = self.user_pipe.workers() + self.book_pipe.workers()
+        if self.bar_pipe is not None:
+            output += self.bar_pipe.workers()
+        return output
+
+    def encode_raw(self, body):
+        """Encode a reply the broker makes itself"""
+        return self.user_pipe.writer.channel.encode_raw(body)
+
+    def status(self):
+        """Report on how busy each worker is, and on the metrics so far"""
+        output = {"workers": {}}
+        for name, pool in (("users", self.user_pipe), ("books", self.book_pipe),
+                           ("barcode", self.bar_pipe)):
+            if pool is None:
+                continue
+            output["workers"][name] = [{"alive": each.alive,
+                                        "in_flight": len(each.pending),
+                                        "queued": each.queued}
+                                       for each in pool.workers()]
+        if self.metrics is None:
+            output["metrics"] = None
+        else:
+            output["metrics"] = self.metrics.report()
+        if self.scans is None:
+            output["scan_cache"] = None
+        else:
+            output["scan_cache"] = self.scans.report()
+        return output
+
+    def dump(self):
+        """Write the metrics out to the file named in the settings"""
+        if self.metrics is not None:
+            self.metrics.dump(common.SETTINGS["metrics"]["dump_path"],
+                              {"workers": self.status()["workers"]})
+
+    def route(self, table):
+        """Get the pool for a table, and every pool a write to it touches
+
+        Returns None for the pool if there isn't one. Also returns the
+        name of the table that metrics are kept under.
+        """
+        if table in ("user", "users"):
+            return self.user_pipe, (self.user_pipe,), "users"
+        if table in ("book", "books"):
+            return self.book_pipe, (self.book_pipe,), "books"
+        if table == "both":
+            # Circulation commands touch both tables, but are done in a
+            # single transaction by one worker
+            return self.book_pipe, (self.book_pipe, self.user_pipe), "both"
+        if table == "barcode":
+            return self.bar_pipe, (), "barcode"
+        return None, (), None
+
+    def send(self, pool, command, handler, writes=None, touches=(),
+             client=None, table=None):
+        """Send a command to the right worker in a pool
+
+        `writes` is the `PendingWrites` of the sending client, and
+        `touches` is every pool the command could write to. `client` is
+        what the worker queues the command under, and `table` what metrics
+        for it are kept under.
+        """
+        if __circulates__(command):
+            # Circulation changes who has what, even in a batch sent to
+            # just one table
+            touches = (self.book_pipe, self.user_pipe)
+        worker = pool.pick(command)
+        if (writes is not None) and not __writes__(command):
+            running = writes.running(pool)
+            if [each for each in running if each is not pool.writer] != []:
+                writes.held.append(lambda: self.send(pool, command, handler,
+                                                     writes, touches, client,
+                                                     table))
+                return
+            if running != []:
+                worker = pool.writer
+        stats = None
+        if self.metrics is not None:
+            stats = self.metrics.command(table, tracing.name_of(command))
+        if (writes is not None) and (touches != ()) and __writes__(command):
+            writes.add(touches, worker)
+            inner = handler
+
+            async def handler(payload):
+                writes.done(touches, worker)
+                await inner(payload)
+        if (self.scans is not None) and (touches != ()) and __writes__(command):
+            uids = __written_uids__(command)
+            self.scans.invalidate(touches, uids)
+            after_write = handler
+
+            async def handler(payload):
+                # Again, for lookups sent while the write was running
+                self.scans.invalidate(touches, uids)
+                await after_write(payload)
+        worker.send(command, handler, client, stats, tracing.trace_of(command))
+
+    def on_barcode(self, handler, client=None, scan="get_barcode"):
+        """Make a handler that looks up what was scanned
+
+        If what was scanned isn't ours, keep scanning. `scan` is the
+        command that asked for the scan.
+        """
+        trace = tracing.trace_of(scan)
+
+        async def on_scan(payload):
+            data = self.bar_pipe.writer.channel.decode_raw(payload)
+            if "type" not in data:
+                # The scanner failed, or timed out
+                await handler(payload)
+                return
+            if data["type"] in ("user", "users"):
+                pool, table = self.user_pipe, "users"
+            elif data["type"] in ("book", "books"):
+                pool, table = self.book_pipe, "books"
+            else:
+                if data["type"] is not None:
+                    print(data)
+                self.send(self.bar_pipe, scan, on_scan, client=client,
+                          table="barcode")
+                return
+            query = qr_query(data)
+            if trace is not None:
+                query["trace"] = trace
+            uid = data["uid"]
+            if (self.scans is None) or not isinstance(uid, (int, str)):
+                self.send(pool, query, handler, client=client, table=table)
+                return
+            cached = self.scans.get(pool, uid)
+            if cached is not None:
+                await handler(cached)
+                return
+            generation = self.scans.generation(pool)
+
+            async def on_lookup(payload):
+                reply = pool.writer.channel.decode_raw(payload)
+                if not (isinstance(reply, dict) and reply.get("status") == 0):
+                    self.scans.put(pool, uid, payload, generation)
+                await handler(payload)
+            self.send(pool, query, on_lookup, client=client, table=table)
+        return on_scan
+
+    async def dispatch(self, request, handler, writes=None, client=None):
+        """Send a request from a client on to whichever worker handles it"""
+        if request == "get_barcode":
+            # Traced scans come as a command dict instead
+            request = {"table": "barcode", "command": "get_barcode"}
+        if (isinstance(request, dict) and
+                tracing.name_of(request.get("command")) == "get_barcode"):
+            if self.bar_pipe is None:
+                await handler(self.encode_raw(__failure__("no_scanner")))
+                return
+            self.send(self.bar_pipe, request["command"],
+                      self.on_barcode(handler, client, request["command"]),
+                      client=client, table="barcode")
+            return
+        if request == "status":
+            await handler(self.encode_raw(self.status()))
+            return
+        target, touches, table = None, (), None
+        # Anything from a terminal could be malformed. Answer it, rather
+        # than dropping the connection.
+        if isinstance(request, dict) and ("command" in request):
+            target, touches, table = self.route(request.get("table"))
+        if target is None:
+            await handler(self.encode_raw(__failure__("bad_request")))
+            return
+        self.send(target, request["command"], handler, writes, touches, client,
+                  table)
+
+    async def serve_client(self, channel, primary=False, authkey=None):
+        """Handle requests from one client until it hangs up
+
+        Each client may only have so many requests waiting on a reply. Past
+        that we stop reading from it, until replies go out, so a client
+        sending faster than we can answer gets held back instead of piling
+        up requests here. Only the primary client (the UI) can shut the
+        broker down.
+
+        If `authkey` is given, the client must prove it knows it first.
+        """
+        if (authkey is not None) and not await channel.challenge(authkey):
+            channel.close()
+            return
+        slots = asyncio.Semaphore(self.settings["client_max_in_flight"])
+        writes = PendingWrites()
+
+        def reply_to(request_id, request):
+            """Make a handler that sends a worker's reply back to the client"""
+            trace = None
+            if isinstance(request, dict):
+                trace = tracing.trace_of(request.get("command"))
+            if trace is not None:
+                start = tracing.now()
+
+            async def handler(payload):
+                if trace is not None:
+                    tracing.span(f"{request['table']} {tracing.name_of(request['command'])}",
+                                 trace, start, flow="t", tid=trace)
+                slots.release()
+                if not channel.writer.is_closing():
+                    # Bounded by `slots`, so no need to wait on the client
+                    channel.write_raw(request_id, payload)
+            return handler
+
+        try:
+            while True:
+                try:
+                    request_id, request = await channel.recv()
+                except EOFError:
+                    break
+                if request == "shut_down":
+                    if primary:
+                        self.stopped.set()
+                    break
+                await slots.acquire()
+                await self.dispatch(request, reply_to(request_id, request),
+                                    writes, channel)
+        finally:
+            channel.close()
+            if primary:
+                self.stopped.set()
+
+
+async def serve(ui_pipe, bar_pipe, user_pipe, book_pipe, path=None,
+                user_readers=(), book_readers=()):
+    """Run the broker until the UI asks us to shut down
+
+    Takes `multiprocessing` connections to the UI and each worker,
+    including any read only workers for each table. In server mode there
+    is no UI or scanner, `ui_pipe` and `bar_pipe` are None, and this runs
+    until stopped with SIGINT or SIGTERM.
+
+    Other clients can attach over a Unix socket at `path`, which defaults
+    to the `broker` `socket` setting, and over TCP if the `tcp` setting is
+    set to a host and port. Set either to null to not listen on it. If the
+    `authkey` setting is set, clients on either must know it. Listening on
+    TCP requires it.
+    """
+    settings = common.SETTINGS["broker"]
+    if path is None:
+        path = settings["socket"]
+    authkey = settings["authkey"]
+    if authkey is not None:
+        authkey = authkey.encode()
+    elif settings["tcp"] is not None:
+        raise ValueError("Listening on TCP needs the 'authkey' setting set")
+    if bar_pipe is not None:
+        bar_pipe = await wire.StreamChannel.from_connection(bar_pipe)
+    broker = Broker(bar_pipe,
+                    await wire.StreamChannel.from_connection(user_pipe),
+                    await wire.StreamChannel.from_connection(book_pipe),
+                    settings,
+                    [await wire.StreamChannel.from_connection(each)
+                     for each in user_readers],
+                    [await wire.StreamChannel.from_connection(each)
+                     for each in book_readers])
+    tasks = [asyncio.ensure_future(each.run()) for each in broker.workers()]
+    if ui_pipe is not None:
+        ui_pipe = await wire.StreamChannel.from_connection(ui_pipe)
+        tasks.append(asyncio.ensure_future(broker.serve_client(ui_pipe,
+                                                               primary=True)))
+    loop = asyncio.get_running_loop()
+    for each in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(each, broker.stopped.set)
+
+    async def on_connect(reader, writer):
+        await broker.serve_client(wire.StreamChannel(reader, writer),
+                                  authkey=authkey)
+
+    if broker.metrics is not None:
+        async def dump():
+            while True:
+                await asyncio.sleep(common.SETTINGS["metrics"]["dump_interval"])
+                broker.dump()
+        if common.SETTINGS["metrics"]["dump_path"] is not None:
+            tasks.append(asyncio.ensure_future(dump()))
+
+    servers = []
+    if path is not None:
+        servers.append(await asyncio.start_unix_server(on_connect, path=path))
+        os.chmod(path, 0o600)
+    if settings["tcp"] is not None:
+        host, port = settings["tcp"]
+        servers.append(await asyncio.start_server(on_connect, host, port))
+    try:
+        await broker.stopped.wait()
+    finally:
+        for each in servers:
+            each.close()
+        if (path is not None) and os.path.exists(path):
+            os.remove(path)
+        for each in tasks:
+            each.cancel()
+        if common.SETTINGS["metrics"]["dump_path"] is not None:
+            broker.dump()
+
+
+def broker(ui_pipe, bar_pipe, user_pipe, book_pipe, user_readers=(),
+           book_readers=()):
+    """Run the broker, blocking until it shuts down"""
+    asyncio.run(serve(ui_pipe, bar_pipe, user_pipe, book_pipe,
+                      user_readers=user_readers, book_readers=book_readers))
+    print("Shutting down...")
+
+
+def connect(address=None, authkey=None):
+    """Attach to a running broker
+
+    `address` is either the path to its Unix socket, or a (host, port)
+    pair for TCP, and defaults to the `broker` `socket` setting. `authkey`
+    defaults to the `authkey` setting. Returns a `wire.RequestPipe`, to be
+    used just like the UI's.
+    """
+    settings = common.SETTINGS["broker"]
+    if address is None:
+        address = settings["socket"]
+    if isinstance(address, list):
+        address = tuple(address)
+    if (authkey is None) and (settings["authkey"] is not None):
+        authkey = settings["authkey"].encode()
+    conn = multiprocessing.connection.Client(address)
+    if authkey is not None:
+        wire.answer_challenge(conn, authkey)
+    return wire.RequestPipe(conn)
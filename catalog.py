@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  catalog.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Shared memory snapshot of the catalog
+
+The book worker publishes the UID, title, and status of every book into
+shared memory. Screens that only browse the catalog can read that directly,
+without going through the broker.
+
+A snapshot lives in its own shared memory segment, laid out as:
+
+ * a header: version, number of books, number of titles, size of titles
+ * the UID of every book, sorted, as 64-bit ints
+ * the index of each book's title in the list of titles, as 32-bit ints
+ * the status of each book, as an index into `STATUSES`
+ * every distinct title, sorted, seperated by null bytes
+
+A small control segment holds the name of the segment with the newest
+snapshot. Each full rebuild goes into a brand new segment, so readers
+never see one half-written. Status changes are written in place, as they
+are a single byte.
+
+Only writes that go through the book worker update the snapshot.
+"""
+import bisect
+import struct
+from multiprocessing import shared_memory, resource_tracker
+import common
+
+
+STATUSES = ("checked_in", "checked_out", "unavailable", "missing")
+UNKNOWN_STATUS = 255
+HEADER = struct.Struct("<QQQQ")
+# Sequence number, and the name of the newest snapshot's segment. The
+# sequence number is odd while the name is being changed.
+CONTROL = struct.Struct("<Q64s")
+# How many times to try reading the name while it's being changed, before
+# giving up. The book worker could have died halfway through.
+READ_TRIES = 1000
+
+
+def __layout__(count, titles_size):
+    """Offsets of each part of a snapshot, and its total size"""
+    uids = HEADER.size
+    title_index = uids + (count * 8)
+    statuses = title_index + (count * 4)
+    titles = statuses + count
+    return uids, title_index, statuses, titles, titles + max(titles_size, 1)
+
+
+def __attach__(name):
+    """Attach to an existing shared memory segment, without owning it
+
+    Before Python 3.13, attaching registers the segment with this
+    process's resource tracker, which unlinks it when we exit, even though
+    the book worker is still using it. So tell the tracker to forget it.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13
+        segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+
+def __unlink__(segment):
+    """Unlink a shared memory segment, if nothing beat us to it"""
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class CatalogPublisher():
+    """Writes snapshots of the catalog, from the book worker"""
+    def __init__(self, db, name=None):
+        """Set up publishing from a DB connection"""
+        if name is None:
+            name = common.SETTINGS["catalog_snapshot"]["name"]
+        self.db = db
+        self.name = name
+        self.generation = 0
+        self.segment = None
+        self.uids = None
+        self.statuses = None
+        try:
+            self.control = shared_memory.SharedMemory(name=name, create=True,
+                                                      size=CONTROL.size)
+        except FileExistsError:
+            # Left over from a previous run
+            self.control = shared_memory.SharedMemory(name=name)
+        self.sequence = CONTROL.unpack_from(self.control.buf)[0] & ~1
+
+    def publish(self):
+        """Rebuild the snapshot from the DB"""
+        rows = self.db.execute("""SELECT uid, name, json_extract(check_in_status, '$.status')
+                                  FROM books ORDER BY uid""").fetchall()
+        titles = sorted({str(each[1]) for each in rows})
+        title_lookup = {title: index for index, title in enumerate(titles)}
+        blob = "\0".join(titles).encode()
+        count = len(rows)
+        uids, title_index, statuses, titles_at, size = __layout__(count, len(blob))
+
+        self.generation += 1
+        segment_name = f"{self.name}-{self.generation}"
+        try:
+            segment = shared_memory.SharedMemory(name=segment_name, create=True,
+                                                 size=size)
+        except FileExistsError:
+            # Left over from a previous run that didn't shut down cleanly
+            shared_memory.SharedMemory(name=segment_name).unlink()
+            segment = shared_memory.SharedMemory(name=segment_name, create=True,
+                                                 size=size)
+        HEADER.pack_into(segment.buf, 0, self.generation, count, len(titles),
+                         len(blob))
+        struct.pack_into(f"<{count}q", segment.buf, uids,
+                         *[each[0] for each in rows])
+        struct.pack_into(f"<{count}I", segment.buf, title_index,
+                         *[title_lookup[str(each[1])] for each in rows])
+        segment.buf[statuses:titles_at] = bytes(
+            [STATUSES.index(each[2]) if each[2] in STATUSES else UNKNOWN_STATUS
+             for each in rows])
+        segment.buf[titles_at:titles_at + len(blob)] = blob
+
+        # Point readers at the new snapshot, then drop the old one. Readers
+        # that still have the old one open can keep using it. The name goes
+        # in while the sequence number is odd, so no reader takes half of it.
+        self.sequence += 1
+        struct.pack_into("<Q", self.control.buf, 0, self.sequence)
+        struct.pack_into("<64s", self.control.buf, 8, segment.name.encode())
+        self.sequence += 1
+        struct.pack_into("<Q", self.control.buf, 0, self.sequence)
+        self.__close_segment__()
+        self.segment = segment
+        self.uids = [each[0] for each in rows]
+        self.statuses = statuses
+
+    def update_status(self, uid):
+        """Write the current status of one book into the snapshot in place
+
+        Returns False if the book isn't in the snapshot, in which case it
+        needs to be rebuilt.
+        """
+        if self.segment is None:
+            return False
+        try:
+            uid = int(uid)
+        except (TypeError, ValueError):
+            return False
+        index = bisect.bisect_left(self.uids, uid)
+        if (index >= len(self.uids)) or (self.uids[index] != uid):
+            return False
+        row = self.db.execute("""SELECT json_extract(check_in_status, '$.status')
+                                 FROM books WHERE uid=?""", (uid,)).fetchone()
+        if row is None:
+            return False
+        if row[0] in STATUSES:
+            self.segment.buf[self.statuses + index] = STATUSES.index(row[0])
+        else:
+            self.segment.buf[self.statuses + index] = UNKNOWN_STATUS
+        return True
+
+    def __close_segment__(self):
+        """Drop the current snapshot"""
+        if self.segment is not None:
+            self.segment.close()
+            __unlink__(self.segment)
+            self.segment = None
+
+    def close(self):
+        """Stop publishing, and clean up"""
+        self.__close_segment__()
+        self.control.close()
+        __unlink__(self.control)
+
+
+class CatalogReader():
+    """Read only view of the newest catalog snapshot"""
+    def __init__(self, name=None):
+        """Set up reading snapshots"""
+        if name is None:
+            name = common.SETTINGS["catalog_snapshot"]["name"]
+        self.name = name
+        self.control = None
+        self.segment = None
+        self.segment_name = None
+
+    def __newest__(self):
+        """Get the name of the segment with the newest snapshot
+
+        Returns an empty name if it's being changed for too long.
+        """
+        if self.control is None:
+            self.control = __attach__(self.name)
+        for each in range(READ_TRIES):
+            sequence, name = CONTROL.unpack_from(self.control.buf)
+            if sequence % 2 == 1:
+                continue
+            if CONTROL.unpack_from(self.control.buf)[0] == sequence:
+                return name.rstrip(b"\0").decode()
+        return ""
+
+    def refresh(self):
+        """Make sure we are looking at the newest snapshot
+
+        Returns False if there is no snapshot to read.
+        """
+        if not common.SETTINGS["catalog_snapshot"]["enabled"]:
+            return False
+        try:
+            name = self.__newest__()
+            if name == "":
+                return False
+            if name != self.segment_name:
+                segment = __attach__(name)
+                self.close()
+                self.segment = segment
+                self.segment_name = name
+        except FileNotFoundError:
+            # The book worker isn't up yet, or replaced the snapshot while
+            # we were looking
+            return False
+        return True
+
+    @property
+    def version(self):
+        """Version of the snapshot being read"""
+        return HEADER.unpack_from(self.segment.buf)[0]
+
+    def __sections__(self):
+        """Views of each part of the snapshot"""
+        version, count, titles_count, titles_size = HEADER.unpack_from(self.segment.buf)
+        uids, title_index, statuses, titles, size = __layout__(count, titles_size)
+        buf = self.segment.buf
+        return (buf[uids:title_index].cast("q"),
+                buf[title_index:statuses].cast("I"),
+                buf[statuses:titles],
+                buf[titles:titles + titles_size])
+
+    def titles(self):
+        """Every distinct title, sorted"""
+        titles = self.__sections__()[3]
+        if len(titles) == 0:
+            return []
+        return str(titles, "utf-8").split("\0")
+
+    def __find__(self, uid):
+        """Get the index of a book, or None if it isn't in the catalog"""
+        uids = self.__sections__()[0]
+        index = bisect.bisect_left(uids, uid)
+        if (index < len(uids)) and (uids[index] == uid):
+            return index
+        return None
+
+    def has_uid(self, uid):
+        """Check if a UID is taken"""
+        return self.__find__(uid) is not None
+
+    def status(self, uid):
+        """Get the status of a book, or None if it isn't in the catalog"""
+        index = self.__find__(uid)
+        if index is None:
+            return None
+        status = self.__sections__()[2][index]
+        if status == UNKNOWN_STATUS:
+            return None
+        return STATUSES[status]
+
+    def close(self):
+        """Stop looking at the current snapshot"""
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+            self.segment_name = None
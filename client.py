@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  client.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Terminal client for a PyLibMan server
+
+Usage:
+
+    python3 client.py [--tcp HOST:PORT] get {books,users} [FIELD VALUE]
+    python3 client.py [--tcp HOST:PORT] {checkout,checkin,renew} BOOK_UID USER_UID
+    python3 client.py [--tcp HOST:PORT] load TERMINALS [SECONDS]
+    python3 client.py [--tcp HOST:PORT] status
+
+Attaches to the broker of `pylibman.py --server` (or of a running desk)
+over its Unix socket, or over TCP with `--tcp`, and sends it the same
+commands the UI does. `load` simulates several terminals at once, each
+looping checkouts and checkins of its own book, and reports how many each
+got through, to check they are served fairly. `status` shows how busy
+each worker is, and the broker's latency metrics.
+"""
+import sys
+import json
+import time
+import multiprocessing
+import common
+import broker
+
+
+class Terminal():
+    """A circulation terminal attached to the broker"""
+    def __init__(self, address=None, authkey=None):
+        """Attach to the broker. See `broker.connect()`"""
+        self.pipe = broker.connect(address, authkey)
+
+    def request(self, table, command):
+        """Send a command to a table, and get the reply"""
+        self.pipe.send({"table": table, "command": command})
+        return self.pipe.recv()
+
+    def get(self, table, field=None, value=None, column="*"):
+        """Get rows of a table, optionally where `field` is `value`"""
+        cmd = common.get_template("get")
+        cmd["column"] = column
+        if field is None:
+            del cmd["filter"]
+        else:
+            cmd["filter"]["field"] = field
+            cmd["filter"]["compare"] = value
+        return self.request(table, cmd)
+
+    def __circulation__(self, cmd_type, book_uid, user_uid):
+        """Check out, check in, or renew a book"""
+        cmd = common.get_template(cmd_type)
+        cmd["data"]["book_uid"] = book_uid
+        cmd["data"]["user_uid"] = user_uid
+        return self.request("both", cmd)
+
+    def check_out(self, book_uid, user_uid):
+        """Check out a book to a user"""
+        return self.__circulation__("checkout", book_uid, user_uid)
+
+    def check_in(self, book_uid, user_uid):
+        """Check in a book from a user"""
+        return self.__circulation__("checkin", book_uid, user_uid)
+
+    def renew(self, book_uid, user_uid):
+        """Renew a user's checkout of a book"""
+        return self.__circulation__("renew", book_uid, user_uid)
+
+    def status(self):
+        """Get the broker's status report"""
+        self.pipe.send("status")
+        return self.pipe.recv()
+
+    def close(self):
+        """Detach from the broker"""
+        self.pipe.send("shut_down")
+
+
+def __terminal_load__(address, book_uid, user_uid, seconds, results):
+    """Loop checkouts and checkins on one terminal, counting them"""
+    terminal = Terminal(address)
+    count = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        terminal.check_out(book_uid, user_uid)
+        terminal.check_in(book_uid, user_uid)
+        count += 1
+    terminal.close()
+    results.put((book_uid, count))
+
+
+def load(terminals, seconds=5, address=None, book_uids=None, user_uid=None):
+    """Run checkout and checkin loops on several terminals at once
+
+    Returns how many cycles each terminal got through, by book UID. By
+    default the first books and user in the DB are used.
+    """
+    if (book_uids is None) or (user_uid is None):
+        terminal = Terminal(address)
+        if book_uids is None:
+            book_uids = terminal.get("books", column="uid")[:terminals]
+        if user_uid is None:
+            user_uid = terminal.get("users", column="uid")[0]
+        terminal.close()
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=__terminal_load__,
+                                     args=(address, each, user_uid, seconds,
+                                           results))
+             for each in book_uids]
+    for each in procs:
+        each.start()
+    output = dict([results.get() for each in procs])
+    for each in procs:
+        each.join()
+    return output
+
+
+def __value__(text):
+    """Convert a command line argument to an int, if it is one"""
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+
+if __name__ == "__main__":
+    ARGS = sys.argv[1:]
+    ADDRESS = None
+    if len(ARGS) > 1 and ARGS[0] == "--tcp":
+        HOST, PORT = ARGS[1].rsplit(":", 1)
+        ADDRESS = (HOST, int(PORT))
+        ARGS = ARGS[2:]
+    if ARGS == ["status"]:
+        TERMINAL = Terminal(ADDRESS)
+        print(json.dumps(TERMINAL.status(), indent=1))
+        TERMINAL.close()
+        sys.exit(0)
+    if len(ARGS) < 2 or ARGS[0] not in ("get", "checkout", "checkin", "renew",
+                                        "load"):
+        common.eprint(__doc__)
+        sys.exit(2)
+    if ARGS[0] == "load":
+        COUNTS = load(int(ARGS[1]), *[int(each) for each in ARGS[2:3]],
+                      address=ADDRESS)
+        for BOOK, COUNT in sorted(COUNTS.items()):
+            print(f"Terminal for book {BOOK}: {COUNT} checkout/checkin cycles")
+        sys.exit(0)
+    TERMINAL = Terminal(ADDRESS)
+    if ARGS[0] == "get":
+        OUTPUT = TERMINAL.get(ARGS[1], *[__value__(each) for each in ARGS[2:4]])
+    elif len(ARGS) < 3:
+        common.eprint(__doc__)
+        sys.exit(2)
+    elif ARGS[0] == "checkout":
+        OUTPUT = TERMINAL.check_out(int(ARGS[1]), int(ARGS[2]))
+    elif ARGS[0] == "checkin":
+        OUTPUT = TERMINAL.check_in(int(ARGS[1]), int(ARGS[2]))
+    else:
+        OUTPUT = TERMINAL.renew(int(ARGS[1]), int(ARGS[2]))
+    TERMINAL.close()
+    print(json.dumps(OUTPUT, indent=1))
@@ -36,6 +36,17 @@ def eprint(*args, **kwargs):
 VERSION = "0.0.1-alpha0"
 HELP = f"""PyLibMan, Version {VERSION}
 
+Usage: pylibman.py [--server] [--trace] [--profile PROCESSES] [--profile-mode MODE]
+
+    --server        Run only the DB workers and broker, for terminals to
+                    attach to over the broker's socket (see client.py)
+    --trace         Trace every request through each process, into the
+                    file in the `tracing` setting. See tracing.py
+    --profile       Profile the processes with these names, seperated by
+                    commas. Shell style patterns, like `PLM-*`, work too.
+                    Profiles are written on exit, or on SIGUSR1
+    --profile-mode  `cprofile` or `sample`. See profiling.py
+
 The rest of this will be assigned later."""
 
 # read settings
@@ -45,19 +56,20 @@ with open("settings.json", "r") as file:
 # DB structures for easy generation of SQLite commands
 db_struct_books = {"uid": "INTEGER",
                    "name": "TEXT",
-                   "check_out_history": "TEXT", # Store this data a a JSON-formatted string
+                   "check_out_history": "TEXT", # No longer written to. History is kept in the `loans` table
                    "check_in_status": "TEXT",   # Also store this as JSON, basic template found in `status_template`
                    "published": "INTEGER"}
 db_struct_users = {"uid": "INTEGER",
                    "name": "TEXT",
                    "contact_info": "TEXT", # Store as JSON-formatted string, template in `contact_info_template`
-                   "checked_out_books": "TEXT", # Store as list of book UIDs
+                   "checked_out_books": "TEXT", # No longer written to. Filled in from the `loans` table
                    "privs": "user"} # either `user` or `admin`
 # JSON templates
 status_template = {"status" : "checked_in", # can be one of: "checked_in", "checked_out", "unavailable", or "missing"
                    "possession": None, # UID of user who has (or should have) book, None if checked in
                    "duration": 0, # Number of days book has been in possession of UID in "possession" field
-                   "due_date": 0} # UNIX time book is due to be returned
+                   "due_date": 0, # UNIX time book is due to be returned
+                   "renewals": 0} # Number of times the current checkout has been renewed
 contact_info_template = {"phone_numbers": [], # list of phone numbers, stored as text
                          "emails": []}
 
@@ -96,6 +108,8 @@ make_qr_template = {"cmd_type": "make_qr",
                     "uid": None}
 print_qr_template = {"cmd_type": "print_qr",
                      "paths": []} # list of file paths to PNGs to print
+batch_template = {"cmd_type": "batch",
+                  "commands": []} # list of commands to run in one transaction. Output is a list of each command's output
 
 
 def get_template(template_name):
@@ -128,6 +142,8 @@ def get_template(template_name):
         return copy.deepcopy(make_qr_template)
     if template_name in ("print_qr", "print"):
         return copy.deepcopy(print_qr_template)
+    if template_name == "batch":
+        return copy.deepcopy(batch_template)
     raise NameError(f"Template for '{template_name}' not found")
 
 
@@ -148,3 +164,6 @@ def set_procname(newname):
 	buff = create_string_buffer(len(newname) + 1) #Note: One larger than the name (man prctl says that)
 	buff.value = bytes(newname, "utf-8")                 #Null terminated string as it should be
 	libc.prctl(15, byref(buff), 0, 0, 0) #Refer to "#define" of "/usr/include/linux/prctl.h" for the misterious value 16 & arg[3..5] are zero as the man page says.
+	import profiling, tracing # Imported here, as they import us
+	profiling.start(newname) # Only does anything if this process is to be profiled
+	tracing.start(newname) # Likewise, if tracing is on
@@ -24,13 +24,24 @@
 """Explain what this program does here!!!"""
 import sqlite3 as sql
 import json
+import sys
+import signal
 import common
+import wire
+import catalog
+import tracing
 import time
 import traceback
+import contextlib
 
 success = {"status": 1}
 failure = {"status": 0}
 
+JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal", "off")
+SYNCHRONOUS_LEVELS = ("off", "normal", "full", "extra")
+# What can go in a batch. Batches can't be nested.
+BATCHABLE = ("get", "ch", "del", "add", "checkout", "checkin", "renew")
+
 def format_db_output(data, table):
     """Format output from the given table into a reasonable format"""
     if table in ("user", "users"):
@@ -62,47 +73,124 @@ def format_db_output(data, table):
     return output
 
 
-def get_struct(db, full=True):
-    output = "("
-    if db in ("user", "users"):
-        for each in common.get_template("db_users"):
-            output = f"{output} {each}"
-            if full:
-                output = output + f" {common.get_template('db_users')[each]}"
-            output = output + ","
-        output = output[:-1] + ")"
-    elif db in ("book", "books"):
-        for each in common.get_template("db_books"):
-            output = f"{output} {each}"
-            if full:
-                output = output + f" {common.get_template('db_books')[each]}"
-            output = output + ","
-        output = output[:-1] + ")"
-    return output
+def connect(path=None, profile=None):
+    """Open a worker connection to the library DB
 
+    Every statement we run is parameterized, so the SQL text for any given
+    command is always the same. That lets SQLite's per-connection statement
+    cache hand back an already-prepared statement instead of re-parsing and
+    re-planning it each time.
 
-def __get_command__(input, db_name, db):
+    The connection is tuned according to `profile`, which names one of the
+    entries in the `connection_profiles` setting. By default, the profile
+    in the `connection_profile` setting is used.
+    """
+    if path is None:
+        path = common.SETTINGS["db_name"]
+    if profile is None:
+        profile = common.SETTINGS["connection_profile"]
+    settings = common.SETTINGS["connection_profiles"][profile]
+    # PRAGMAs don't take parameters, so check everything before using it
+    journal_mode = settings["journal_mode"].lower()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f"Invalid journal mode: '{journal_mode}'")
+    synchronous = settings["synchronous"].lower()
+    if synchronous not in SYNCHRONOUS_LEVELS:
+        raise ValueError(f"Invalid synchronous level: '{synchronous}'")
+    db = sql.connect(path,
+                     cached_statements=common.SETTINGS["statement_cache_size"])
+    db.execute(f"PRAGMA busy_timeout={int(settings['busy_timeout'])}")
+    db.execute(f"PRAGMA journal_mode={journal_mode}")
+    db.execute(f"PRAGMA synchronous={synchronous}")
+    db.execute(f"PRAGMA cache_size={int(settings['cache_size'])}")
+    db.execute(f"PRAGMA mmap_size={int(settings['mmap_size'])}")
+    return db
+
+
+def __table_name__(db_name):
+    """Map the various spellings of a table name to the real table"""
     if db_name.lower() in ("user", "users"):
-        name = "users"
-    elif db_name.lower() in ("book", "books"):
-        name = "books"
-    command = f"SELECT {input['column']} FROM {name}"
-    if "filter" in input.keys():
-        if input["filter"] != None:
-            if None not in (input["filter"]["field"],
-                            input["filter"]["compare"]):
-                command = f"{command} WHERE {input['filter']['field']}"
-                if isinstance(input['filter']['compare'], str):
-                    command = f"{command}=\"{input['filter']['compare']}\""
-                elif isinstance(input['filter']['compare'], (dict, list)):
-                    command = f"{command}='{json.dumps(input['filter']['compare'])}'"
-                else:
-                    command = f"{command}={input['filter']['compare']}"
-    unformatted = list(db.execute(command).fetchall())
+        return "users"
+    if db_name.lower() in ("book", "books"):
+        return "books"
+    raise ValueError(f"Unknown table: '{db_name}'")
+
+
+def __check_column__(column, name):
+    """Make sure `column` is a real column of table `name`
+
+    Column names can't be bound as parameters, so anything that ends up
+    spliced into a statement has to be checked against the table structure
+    first.
+    """
+    if column not in common.get_template(name):
+        raise ValueError(f"Unknown column for table '{name}': '{column}'")
+    return column
+
+
+def __bind__(value):
+    """Convert a value into something SQLite can bind"""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def __where__(filter, name):
+    """Generate a WHERE clause, and its parameters, from a filter"""
+    if filter is None:
+        return "", ()
+    if None in (filter["field"], filter["compare"]):
+        return "", ()
+    field = __check_column__(filter["field"], name)
+    return f" WHERE {field}=?", (__bind__(filter["compare"]),)
+
+
+def __loan_column__(name, column, uid, value, db):
+    """Fill in a column that's now kept in the loans table
+
+    `value` is the column as stored, and so is what comes back, as JSON.
+    Other columns come back as they are.
+    """
+    if (name, column) not in (("users", "checked_out_books"),
+                              ("books", "check_out_history")):
+        return value
+    try:
+        legacy = json.loads(value)
+    except (json.decoder.JSONDecodeError, TypeError):
+        legacy = None
+    if name == "users":
+        return json.dumps(__holdings__(uid, legacy, db))
+    if legacy in ([], None):
+        return json.dumps(__loan_history__(uid, db))
+    return value
+
+
+def __get_command__(input, db_name, db):
+    name = __table_name__(db_name)
+    if input["column"] == "*":
+        columns = "*"
+    else:
+        requested = [__check_column__(each.strip(), name)
+                     for each in input["column"].split(",")]
+        # The UID is needed to fill in columns from the loans table
+        columns = ", ".join(["uid"] + requested)
+    where, params = __where__(input.get("filter"), name)
+    command = f"SELECT {columns} FROM {name}{where}"
+    unformatted = list(db.execute(command, params).fetchall())
+    if input["column"] != "*":
+        unformatted = [tuple([__loan_column__(name, column, each[0], value, db)
+                              for column, value in zip(requested, each[1:])])
+                       for each in unformatted]
     output = []
     if input["column"] == "*":
         for each in unformatted:
             output.append(format_db_output(each, name))
+            if name == "books" and output[-1]["check_out_history"] == []:
+                output[-1]["check_out_history"] = __loan_history__(each[0], db)
+            elif name == "users":
+                output[-1]["checked_out_books"] = __holdings__(each[0],
+                                                               output[-1]["checked_out_books"],
+                                                               db)
     else:
         if unformatted != []:
             # we know unformatted is a list with a non-zero length. We can iterate
@@ -135,26 +223,14 @@ def __get_command__(input, db_name, db):
 
 
 def __change_command__(input, db_name, db):
-    if db_name.lower() in ("user", "users"):
-        name = "users"
-    elif db_name.lower() in ("book", "books"):
-        name = "books"
-    command = f"UPDATE {name} SET {input['settings']['ch_field']}="
-    if isinstance(input['settings']['new'], str):
-        command = command + f"\"{input['settings']['new']}\" WHERE "
-    elif isinstance(input['settings']['new'], (dict, list)):
-        command = command + f"'{json.dumps(input['settings']['new'])}' WHERE "
-    else:
-        command = command + f"{input['settings']['new']} WHERE "
-    command = command + f"{input['settings']['search_term']}="
-    if isinstance(input['settings']['search_value'], str):
-        command = command + f"\"{input['settings']['search_value']}\""
-    elif isinstance(input['settings']['search_value'], (dict, list)):
-        command = command + f"'{json.dumps(input['settings']['search_value'])}'"
-    else:
-        command = command + f"{input['settings']['search_value']}"
+    name = __table_name__(db_name)
+    settings = input["settings"]
     try:
-        db.execute(command)
+        field = __check_column__(settings["ch_field"], name)
+        search_term = __check_column__(settings["search_term"], name)
+        db.execute(f"UPDATE {name} SET {field}=? WHERE {search_term}=?",
+                   (__bind__(settings["new"]),
+                    __bind__(settings["search_value"])))
         output = success
     except:
         output = failure
@@ -162,10 +238,8 @@ def __change_command__(input, db_name, db):
 
 
 def __del_command__(input, db_name, db):
-    if db_name.lower() in ("user", "users"):
-        name = "users"
-    elif db_name.lower() in ("book", "books"):
-        name = "books"
+    name = __table_name__(db_name)
+    if name == "books":
         # before deleting a book, make sure it is checked in
         cmd = common.get_template("get")
         cmd["filter"]["field"] = input['filter']['field']
@@ -174,10 +248,12 @@ def __del_command__(input, db_name, db):
         if book["check_in_status"]["status"] != "checked_in":
             return {"status": 2, "reason": book["check_in_status"]["status"],
                     "user": book["check_in_status"]["possession"]}
-    command = f"DELETE FROM {name} WHERE {input['filter']['field']}="
-    command = command + f"{input['filter']['compare']}"
     try:
-        db.execute(command)
+        where, params = __where__(input["filter"], name)
+        if where == "":
+            # Refuse to empty a whole table because of a malformed filter
+            raise ValueError("Delete commands require a filter")
+        db.execute(f"DELETE FROM {name}{where}", params)
         output = success
     except Exception as e:
         output = failure
@@ -185,260 +261,381 @@ def __del_command__(input, db_name, db):
     return output
 
 
-def user_table(pipe):
-    """Interface to interact with the 'user' table"""
-    common.set_procname("PLM-user-db")
-    db = sql.connect(common.SETTINGS["db_name"])
-    struct = get_struct("user", full=False)
-    while True:
-        output = None
-        input = pipe.recv() # Receive our commands from the pipe
-        if input["cmd_type"].lower() == "get":
-            output = __get_command__(input, "users", db)
-        elif input["cmd_type"].lower() == "ch":
-            output = __change_command__(input, "users", db)
-        elif input["cmd_type"].lower() == "del":
-            output = __del_command__(input, "users", db)
-        elif input["cmd_type"].lower() == "add":
-            command = "INSERT INTO users VALUES"
-            data = f"({input['data']['uid']}, '{input['data']['name']}',"
-            data = data + f"'{json.dumps(input['data']['contact_info'])}',"
-            data = data + f"'{json.dumps(input['data']['checked_out_books'])}',"
-            data = data + f"'{input['data']['privs']}')"
-            command = command + " " + data
-            try:
-                db.execute(command)
-                output = success
-            except:
-                output = failure
-        elif input["cmd_type"].lower() == "checkout":
-            # Perform checkout
-            try:
-                check_out_user(input["data"]["book_uid"],
-                               input["data"]["user_uid"], db)
-                output = success
-            except Exception as error:
-                output = failure
-                traceback.print_exc()
-        elif input["cmd_type"].lower() == "checkin":
-            # Perform checkout
-            try:
-                check_in_user(input["data"]["book_uid"],
-                              input["data"]["user_uid"], db)
-                output = success
-            except Exception as error:
-                output = failure
-                traceback.print_exc()
-        elif input["cmd_type"].lower() == "renew":
-            # The easiest way to do this is to check a book in then check
-            # it back out again. This saves code complexity, but at the same
-            # time slows down the system and increases I/O
-            # OPTIMIZE: make seperate "renew" function later that only modifies
-            # what is necessary
-            try:
-                check_in_user(input["data"]["book_uid"],
-                              input["data"]["user_uid"], db)
-                output = success
-            except Exception as error:
-                output = failure
-                traceback.print_exc()
-            if output != failure:
-                try:
-                    check_out_user(input["data"]["book_uid"],
-                                   input["data"]["user_uid"], db)
-                    output = success
-                except Exception as error:
-                    output = failure
-                    traceback.print_exc()
-        db.commit()
-        pipe.send(output)
+def __add_command__(input, db_name, db):
+    name = __table_name__(db_name)
+    columns = list(common.get_template(name))
+    command = f"INSERT INTO {name} ({', '.join(columns)}) VALUES "
+    command = command + f"({', '.join(['?'] * len(columns))})"
+    try:
+        db.execute(command, [__bind__(input["data"][each])
+                             for each in columns])
+        output = success
+    except:
+        output = failure
+    return output
 
 
-def book_table(pipe):
-    """Interface to interact with the 'book' table"""
-    common.set_procname("PLM-book-db")
-    db = sql.connect(common.SETTINGS["db_name"])
-    struct = get_struct("book", full=False)
-    while True:
-        output = None
-        input = pipe.recv() # Receive our commands from the pipe
-        if input["cmd_type"].lower() == "get":
-            output = __get_command__(input, "books", db)
-        elif input["cmd_type"].lower() == "ch":
-            output = __change_command__(input, "books", db)
-        elif input["cmd_type"].lower() == "del":
-            output = __del_command__(input, "books", db)
-        elif input["cmd_type"].lower() == "add":
-            command = "INSERT INTO books VALUES"
-            data = f"({input['data']['uid']}, '{input['data']['name']}',"
-            data = data + f"'{json.dumps(input['data']['check_out_history'])}',"
-            data = data + f"'{json.dumps(input['data']['check_in_status'])}',"
-            data = data + f"'{input['data']['published']}')"
-            command = command + " " + data
-            try:
-                db.execute(command)
-                output = success
-            except:
-                output = failure
-        elif input["cmd_type"].lower() == "checkout":
-            # Perform checkout
-            try:
-                output = check_out_book(input["data"]["book_uid"],
-                                        input["data"]["user_uid"], db)
-            except Exception as error:
-                output = failure
-                traceback.print_exc()
-        elif input["cmd_type"].lower() == "checkin":
-            # Perform checkin
-            try:
-                check_in_book(input["data"]["book_uid"],
-                              input["data"]["user_uid"], db)
-                output = success
-            except Exception as error:
-                output = failure
-                traceback.print_exc()
-        elif input["cmd_type"].lower() == "renew":
-            # The easiest way to do this is to check a book in then check
-            # it back out again. This saves code complexity, but at the same
-            # time slows down the system and increases I/O
-            # OPTIMIZE: make seperate "renew" function later that only modifies
-            # what is necessary
+@contextlib.contextmanager
+def transaction(db):
+    """Run everything inside the `with` block as one transaction
+
+    The write lock is taken up front, so nothing can change between the
+    reads and writes in the block. If the block raises, every change it
+    made is rolled back.
+
+    When already inside a transaction, the block gets a savepoint instead,
+    so only its own changes are rolled back if it raises.
+    """
+    if db.in_transaction:
+        db.execute("SAVEPOINT plm")
+        try:
+            yield db
+        except:
+            db.execute("ROLLBACK TO plm")
+            db.execute("RELEASE plm")
+            raise
+        db.execute("RELEASE plm")
+        return
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except:
+        db.rollback()
+        raise
+    db.commit()
+
+
+def __run_command__(input, db_name, db):
+    """Run one command against the given table"""
+    cmd_type = input["cmd_type"].lower()
+    output = None
+    if cmd_type == "get":
+        output = __get_command__(input, db_name, db)
+    elif cmd_type == "ch":
+        output = __change_command__(input, db_name, db)
+    elif cmd_type == "del":
+        output = __del_command__(input, db_name, db)
+    elif cmd_type == "add":
+        output = __add_command__(input, db_name, db)
+    elif cmd_type in ("checkout", "checkin", "renew"):
+        output = __circulation_command__(input, db)
+    elif cmd_type == "batch":
+        output = __batch_command__(input, db_name, db)
+    return output
+
+
+def __try_command__(input, db_name, db):
+    """Run one command, answering with `failure` if it errors out
+
+    In server mode any terminal can send us commands, so a malformed one
+    mustn't take the worker down for every desk. Whatever it did is rolled
+    back.
+    """
+    try:
+        return __run_command__(input, db_name, db)
+    except Exception:
+        traceback.print_exc()
+        db.rollback()
+        return failure
+
+
+def __batch_command__(input, db_name, db):
+    """Run a list of commands in a single transaction
+
+    Returns a list with the output of each command, in order. Each command
+    gets its own savepoint, so one that errors out doesn't undo the others.
+    Anything that isn't a command we can batch gets `failure`.
+    """
+    output = []
+    with transaction(db):
+        for each in input["commands"]:
             try:
-                check_in_book(input["data"]["book_uid"],
-                              input["data"]["user_uid"], db)
-                output = success
+                if each["cmd_type"].lower() not in BATCHABLE:
+                    output.append(failure)
+                    continue
+                with transaction(db):
+                    output.append(__run_command__(each, db_name, db))
             except Exception as error:
-                output = failure
+                output.append(failure)
                 traceback.print_exc()
-            db.commit()
-            if output != failure:
-                try:
-                    output = check_out_book(input["data"]["book_uid"],
-                                            input["data"]["user_uid"], db)
-                    print(output)
-                except Exception as error:
-                    output = failure
-                    traceback.print_exc()
-        db.commit()
-        pipe.send(output)
+    return output
+
+
+def __circulation_command__(input, db):
+    """Perform a checkout, checkin, or renew across both tables at once"""
+    cmd_type = input["cmd_type"].lower()
+    book_uid = input["data"]["book_uid"]
+    user_uid = input["data"]["user_uid"]
+    try:
+        with transaction(db):
+            if cmd_type == "checkout":
+                output = check_out(book_uid, user_uid, db)
+            elif cmd_type == "checkin":
+                output = check_in(book_uid, user_uid, db)
+            elif cmd_type == "renew":
+                output = renew(book_uid, user_uid, db)
+    except Exception as error:
+        output = failure
+        traceback.print_exc()
+    return output
+
+
+def __loan_history__(book_uid, db):
+    """Get the checkout history of a book, newest first
+
+    This is in the same shape as the old `check_out_history` JSON blob.
+    """
+    output = []
+    for user_uid, checked_out, due, returned_at in db.execute(
+            """SELECT user_uid, checked_out, due, returned_at FROM loans
+               WHERE book_uid=? ORDER BY checked_out DESC""", (book_uid,)):
+        history = common.get_template("check_out_history")
+        history["uid"] = user_uid
+        history["checked_out"] = checked_out
+        history["due_date"] = due
+        history["returned"] = returned_at is not None
+        output.append(history)
+    return output
+
+
+def __holdings__(user_uid, legacy, db):
+    """Get the UIDs of every book a user has checked out
+
+    `legacy` is the user's old `checked_out_books` list. Books on it were
+    checked out before loans were tracked in their own table, and come off
+    of it when they are checked back in.
+    """
+    output = [each[0] for each in db.execute(
+        """SELECT book_uid FROM loans WHERE user_uid=? AND returned_at IS NULL
+           ORDER BY checked_out""", (user_uid,))]
+    if isinstance(legacy, list):
+        for each in legacy:
+            if each not in output:
+                output.append(each)
+    return output
+
+
+def __get_circulation_row__(table, column, uid, db):
+    """Get the JSON circulation data for a book or user"""
+    row = db.execute(f"SELECT {column} FROM {table} WHERE uid=?",
+                     (uid,)).fetchone()
+    if row is None:
+        raise LookupError(f"No entry in '{table}' with UID {uid}")
+    return [json.loads(each) for each in row]
+
+
+def move_history(db, book_uid, history, status):
+    """Move a book's JSON checkout history into the `loans` table
+
+    `history` and `status` are the decoded `check_out_history` and
+    `check_in_status` of the book. This should be run inside a transaction.
+    """
+    # History is stored newest first. Only the newest entry can still be
+    # open, and only if the book is actually out. We never recorded when
+    # older loans came back, so those get a `returned_at` of 0.
+    loans = []
+    for index, each in enumerate(history):
+        returned_at = 0
+        if ((index == 0) and (not each["returned"])
+                and (status["status"] in ("checked_out", "missing"))):
+            returned_at = None
+        loans.append((book_uid, each["uid"], each["checked_out"],
+                      each["due_date"], returned_at))
+    loans.reverse()
+    db.executemany("""INSERT INTO loans (book_uid, user_uid, checked_out, due,
+                                         returned_at)
+                      VALUES (?, ?, ?, ?, ?)""", loans)
+    db.execute("UPDATE books SET check_out_history='[]' WHERE uid=?",
+               (book_uid,))
+
+
+def __get_book_status__(book_uid, db):
+    """Get the check in status of a book
 
+    If the book still has its checkout history in the old JSON blob, it is
+    moved into the `loans` table first.
+    """
+    status, history = __get_circulation_row__("books",
+                                              "check_in_status, check_out_history",
+                                              book_uid, db)
+    if history not in (None, []):
+        move_history(db, book_uid, history, status)
+    return status
 
-def check_out_book(book_uid, user_uid, db):
-    """Perform checkout of book"""
+
+def check_out(book_uid, user_uid, db):
+    """Check a book out to a user
+
+    Returns the due date on success.
+    """
+    status = __get_book_status__(book_uid, db)
     # Check to make sure the book is checked in
-    cmd = common.get_template("get")
-    cmd["filter"]["field"] = "uid"
-    cmd["filter"]["compare"] = book_uid
-    book = __get_command__(cmd, "books", db)[0]
-    if book["check_in_status"]["status"] != "checked_in":
-        return {"status": 2, "reason": book["check_in_status"]["status"],
-                "user": book["check_in_status"]["possession"]}
-    # Update checkout status
+    if status["status"] != "checked_in":
+        return {"status": 2, "reason": status["status"],
+                "user": status["possession"]}
+    if db.execute("SELECT 1 FROM users WHERE uid=?", (user_uid,)).fetchone() is None:
+        raise LookupError(f"No entry in 'users' with UID {user_uid}")
+
     check_out_time = time.time()
     days = common.SETTINGS["default_checkout_days"]
+    # Round it to the nearest second
     due_date = int(check_out_time + (days * 24 * 60 * 60))
     new_status = common.get_template("status")
     new_status["status"] = "checked_out"
     new_status["possession"] = int(user_uid)
-    # Round it to the nearest second. May
     new_status["due_date"] = due_date
-    cmd = common.get_template("change")
-    cmd["settings"]["ch_field"] = "check_in_status"
-    cmd["settings"]["new"] = new_status
-    cmd["settings"]["search_term"] = "uid"
-    cmd["settings"]["search_value"] = book_uid
-    __change_command__(cmd, "books", db)
-
-    # Check out status is now updated.
-    # Update checkout history
-
-    cmd = common.get_template("get")
-    cmd["filter"]["field"] = "uid"
-    cmd["filter"]["compare"] = book_uid
-    history = __get_command__(cmd, "books", db)[0]["check_out_history"]
-    new_history = common.get_template("check_out_history")
-    new_history["uid"] = user_uid
-    new_history["checked_out"] = check_out_time
-    new_history["due_date"] = due_date
-    history.insert(0, new_history)
-    cmd = common.get_template("change")
-    cmd["settings"]["ch_field"] = "check_out_history"
-    cmd["settings"]["new"] = history
-    cmd["settings"]["search_term"] = "uid"
-    cmd["settings"]["search_value"] = book_uid
-    __change_command__(cmd, "books", db)
-
-    cmd = common.get_template("get")
-    cmd["filter"]["field"] = "uid"
-    cmd["filter"]["compare"] = book_uid
-
+    db.execute("UPDATE books SET check_in_status=? WHERE uid=?",
+               (__bind__(new_status), book_uid))
+    db.execute("""INSERT INTO loans (book_uid, user_uid, checked_out, due)
+                  VALUES (?, ?, ?, ?)""",
+               (book_uid, int(user_uid), check_out_time, due_date))
     return due_date
 
 
-def check_out_user(book_uid, user_uid, db):
-    """Perform checkout of book"""
-    # Check to make sure the book is checked in
-    cmd = common.get_template("get")
-    cmd["filter"]["field"] = "uid"
-    cmd["filter"]["compare"] = user_uid
-    books = __get_command__(cmd, "users", db)[0]["checked_out_books"]
-    books.append(book_uid)
-    cmd = common.get_template("change")
-    cmd["settings"]["ch_field"] = "checked_out_books"
-    cmd["settings"]["new"] = books
-    cmd["settings"]["search_term"] = "uid"
-    cmd["settings"]["search_value"] = user_uid
-    __change_command__(cmd, "user", db)
-
-
-def check_in_user(book_uid, user_uid, db):
-    """Perform checkin of book"""
-    # Check to make sure the book is checked in
-    cmd = common.get_template('get')
-    cmd["filter"]["field"] = "uid"
-    cmd["filter"]["compare"] = user_uid
-    books = __get_command__(cmd, "users", db)[0]["checked_out_books"]
-    del books[books.index(book_uid)]
-    cmd = common.get_template("change")
-    cmd["settings"]["ch_field"] = "checked_out_books"
-    cmd["settings"]["new"] = books
-    cmd["settings"]["search_term"] = "uid"
-    cmd["settings"]["search_value"] = user_uid
-    __change_command__(cmd, "user", db)
-
-
-def check_in_book(book_uid, user_uid, db):
-    """Perform checkout of book"""
-    # Check to make sure the book is checked in
-    cmd = common.get_template("get")
-    cmd["filter"]["field"] = "uid"
-    cmd["filter"]["compare"] = book_uid
-    book = __get_command__(cmd, "books", db)[0]
-    if book["check_in_status"]["status"] not in ("checked_out", "missing"):
-        return {"status": 2, "reason": book["check_in_status"]["status"]}
-
-    cmd = common.get_template("change")
-    cmd["settings"]["ch_field"] = "check_in_status"
-    cmd["settings"]["new"] = common.get_template("status")
-    cmd["settings"]["search_term"] = "uid"
-    cmd["settings"]["search_value"] = book_uid
-
-    # Check out status is now updated.
-    # Update checkout history
-
-    cmd = common.get_template("get")
-    cmd["filter"]["field"] = "uid"
-    cmd["filter"]["compare"] = book_uid
-    history = __get_command__(cmd, "books", db)[0]
-    history = history["check_out_history"]
-    history[0]["returned"] = True
-    cmd = common.get_template("change")
-    cmd["settings"]["ch_field"] = "check_out_history"
-    cmd["settings"]["new"] = history
-    cmd["settings"]["search_term"] = "uid"
-    cmd["settings"]["search_value"] = book_uid
-    __change_command__(cmd, "books", db)
-
-    cmd = common.get_template("get")
-    cmd["filter"]["field"] = "uid"
-    cmd["filter"]["compare"] = book_uid
+def check_in(book_uid, user_uid, db):
+    """Check a book back in"""
+    status = __get_book_status__(book_uid, db)
+    # Check to make sure the book is checked out
+    if status["status"] not in ("checked_out", "missing"):
+        return {"status": 2, "reason": status["status"]}
+    db.execute("UPDATE books SET check_in_status=? WHERE uid=?",
+               (__bind__(common.get_template("status")), book_uid))
+    db.execute("""UPDATE loans SET returned_at=?
+                  WHERE book_uid=? AND returned_at IS NULL""",
+               (time.time(), book_uid))
+
+    # If the book was checked out before loans had their own table, it also
+    # has to come off of the old list of whoever had it
+    if status["possession"] is not None:
+        user_uid = status["possession"]
+    db.execute("""UPDATE users SET checked_out_books=(
+                      SELECT json_group_array(value) FROM json_each(checked_out_books)
+                      WHERE value != ?)
+                  WHERE uid=? AND checked_out_books != '[]'""",
+               (book_uid, user_uid))
+    return success
+
+
+def renew(book_uid, user_uid, db):
+    """Renew a book
+
+    Only the due date of the book and of its open loan change, so this is
+    done as a pair of UPDATEs. The checks that the book is checked out to
+    this user and hasn't hit the renewal limit are part of the first
+    UPDATE, so nothing is touched unless the renewal is allowed. Returns
+    the new due date on success.
+    """
+    days = common.SETTINGS["default_checkout_days"]
+    due_date = int(time.time() + (days * 24 * 60 * 60))
+    renewed = db.execute("""UPDATE books
+        SET check_in_status=json_set(check_in_status,
+                                     '$.due_date', ?,
+                                     '$.renewals',
+                                     ifnull(json_extract(check_in_status, '$.renewals'), 0) + 1)
+        WHERE uid=?
+            AND json_extract(check_in_status, '$.status')='checked_out'
+            AND json_extract(check_in_status, '$.possession')=?
+            AND ifnull(json_extract(check_in_status, '$.renewals'), 0) < ?""",
+                         (due_date, book_uid, int(user_uid),
+                          common.SETTINGS["max_renewals"])).rowcount
+    if renewed == 1:
+        # Make sure the loan being renewed is in the loans table
+        __get_book_status__(book_uid, db)
+        db.execute("""UPDATE loans SET due=?
+                      WHERE book_uid=? AND returned_at IS NULL""",
+                   (due_date, book_uid))
+        return due_date
+    # Figure out why we couldn't renew
+    status = __get_circulation_row__("books", "check_in_status",
+                                     book_uid, db)[0]
+    if status["status"] != "checked_out":
+        return {"status": 2, "reason": status["status"]}
+    if status["possession"] != int(user_uid):
+        return {"status": 2, "reason": "checked_out",
+                "user": status["possession"]}
+    return {"status": 2, "reason": "renewal_limit",
+            "user": status["possession"]}
+
+
+def user_table(pipe):
+    """Interface to interact with the 'user' table"""
+    common.set_procname("PLM-user-db")
+    pipe = wire.Channel(pipe)
+    db = connect()
+    while True:
+        request_id, input = pipe.recv() # Receive our commands from the pipe
+        start = tracing.now()
+        output = __try_command__(input, "users", db)
+        db.commit()
+        if tracing.trace_of(input) is not None:
+            tracing.span(f"users {tracing.name_of(input)}",
+                         tracing.trace_of(input), start, flow="f")
+        pipe.send(request_id, output)
+
+
+def read_table(pipe, table, number=0):
+    """Read only interface to a table, for `get` commands
+
+    Any number of these can run alongside the table's one writer, so big
+    reads don't hold up writes queued behind them. They only ever read, so
+    they refuse anything other than a `get`.
+    """
+    common.set_procname(f"PLM-{__table_name__(table)}-r{number}")
+    pipe = wire.Channel(pipe)
+    db = connect()
+    db.execute("PRAGMA query_only=ON")
+    while True:
+        request_id, input = pipe.recv() # Receive our commands from the pipe
+        start = tracing.now()
+        if isinstance(input, dict) and str(input.get("cmd_type")).lower() == "get":
+            output = __try_command__(input, table, db)
+        else:
+            output = failure
+        if tracing.trace_of(input) is not None:
+            tracing.span(f"{table} {tracing.name_of(input)} (reader {number})",
+                         tracing.trace_of(input), start, flow="f")
+        pipe.send(request_id, output)
+
+
+def book_table(pipe):
+    """Interface to interact with the 'book' table"""
+    common.set_procname("PLM-book-db")
+    # We're shut down with SIGTERM. Exit cleanly on it, so the snapshot's
+    # shared memory gets cleaned up below.
+    if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    pipe = wire.Channel(pipe)
+    db = connect()
+    snapshot = None
+    if common.SETTINGS["catalog_snapshot"]["enabled"]:
+        snapshot = catalog.CatalogPublisher(db)
+        snapshot.publish()
+    stale = False
+    try:
+        while True:
+            request_id, input = pipe.recv() # Receive our commands from the pipe
+            start = tracing.now()
+            output = __try_command__(input, "books", db)
+            db.commit()
+            if tracing.trace_of(input) is not None:
+                tracing.span(f"books {tracing.name_of(input)}",
+                             tracing.trace_of(input), start, flow="f")
+            pipe.send(request_id, output)
+            if (snapshot is None) or not isinstance(input, dict):
+                continue
+            if input.get("cmd_type") in ("checkout", "checkin", "renew"):
+                try:
+                    if not snapshot.update_status(input["data"]["book_uid"]):
+                        stale = True
+                except (KeyError, TypeError):
+                    # Malformed command. Rebuild rather than guess.
+                    stale = True
+            elif input.get("cmd_type") in ("add", "ch", "del", "batch"):
+                stale = True
+            # Only rebuild once the burst of writes is over
+            if stale and not pipe.poll():
+                snapshot.publish()
+                stale = False
+    finally:
+        if snapshot is not None:
+            snapshot.close()
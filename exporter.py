@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  exporter.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Export and snapshot of PyLibMan's data
+
+Usage:
+
+    python3 exporter.py {books,users,loans} FILE
+    python3 exporter.py snapshot FILE
+
+Exports go straight from the DB to a CSV or JSONL file (picked by the
+extension of FILE), a row at a time, so memory use stays the same however
+big the catalog gets. A snapshot is a consistent copy of the whole DB,
+made with SQLite's backup API. Neither goes through the broker, and both
+can be run while the desk is in use.
+"""
+import sys
+import csv
+import json
+import sqlite3 as sql
+import common
+import db
+
+
+# Columns of each table that are stored as JSON
+JSON_COLUMNS = {"books": ("check_out_history", "check_in_status"),
+                "users": ("contact_info", "checked_out_books"),
+                "loans": ()}
+LOAN_COLUMNS = ("id", "book_uid", "user_uid", "checked_out", "due",
+                "returned_at")
+# Columns no longer written to, and what to export in their place, the
+# same as the DB workers give. A book's history comes from its loans,
+# newest first, unless it still has one from before loans were tracked. A
+# user's books come from their open loans, then anything left on their old
+# list.
+DERIVED_COLUMNS = {"books": {"check_out_history": """(
+    CASE WHEN json_valid(books.check_out_history)
+            AND json(books.check_out_history) NOT IN ('[]', 'null')
+        THEN books.check_out_history
+        -- Built as text, as SQLite's JSON functions round floats to 15
+        -- digits, which isn't enough to give back the same checkout time
+        ELSE (SELECT '[' || coalesce(group_concat(printf(
+                  '{"uid": %s, "checked_out": %s, "due_date": %s, "returned": %s}',
+                  json_quote(user_uid),
+                  CASE WHEN typeof(checked_out)='real'
+                      THEN printf('%!.17g', checked_out)
+                      ELSE json_quote(checked_out) END,
+                  json_quote(due),
+                  CASE WHEN returned_at IS NULL THEN 'false' ELSE 'true' END),
+                  ', '), '') || ']'
+              FROM (SELECT * FROM loans WHERE loans.book_uid=books.uid
+                    ORDER BY checked_out DESC))
+    END)"""},
+                   "users": {"checked_out_books": """(
+    SELECT json_group_array(book_uid) FROM (
+        SELECT book_uid, 0 AS part, checked_out AS position FROM loans
+            WHERE loans.user_uid=users.uid AND returned_at IS NULL
+        UNION ALL
+        SELECT value, 1, key FROM json_each(
+            CASE WHEN json_valid(users.checked_out_books)
+                THEN users.checked_out_books ELSE '[]' END)
+            WHERE value NOT IN (SELECT book_uid FROM loans
+                                WHERE loans.user_uid=users.uid
+                                    AND returned_at IS NULL)
+        ORDER BY part, position))"""}}
+
+
+def connect_read_only(path=None):
+    """Open a read only connection to the library DB"""
+    if path is None:
+        path = common.SETTINGS["db_name"]
+    return sql.connect(f"file:{path}?mode=ro", uri=True)
+
+
+def __rows__(table, conn):
+    """Stream every row of a table out of the DB, as dicts"""
+    if table == "loans":
+        columns = LOAN_COLUMNS
+    else:
+        columns = tuple(common.get_template(table))
+    # A single SELECT reads from one consistent view of the DB, even if the
+    # desk writes to it while we work
+    derived = DERIVED_COLUMNS.get(table, {})
+    selected = [derived.get(each, each) for each in columns]
+    cursor = conn.execute(f"SELECT {', '.join(selected)} FROM {table} ORDER BY 1")
+    for each in cursor:
+        yield dict(zip(columns, each))
+
+
+def export_table(table, path, conn=None):
+    """Export a table to a CSV or JSONL file
+
+    Returns the number of rows exported.
+    """
+    if table != "loans":
+        table = db.__table_name__(table)
+    if conn is None:
+        conn = connect_read_only()
+    count = 0
+    with open(path, "w", newline="") as file:
+        if path.lower().endswith((".jsonl", ".ndjson", ".json")):
+            for row in __rows__(table, conn):
+                # JSON columns are embedded as JSON, not as text
+                for each in JSON_COLUMNS[table]:
+                    try:
+                        row[each] = json.loads(row[each])
+                    except (TypeError, json.decoder.JSONDecodeError):
+                        pass
+                file.write(json.dumps(row) + "\n")
+                count += 1
+        else:
+            writer = None
+            for row in __rows__(table, conn):
+                if writer is None:
+                    writer = csv.DictWriter(file, fieldnames=list(row))
+                    writer.writeheader()
+                writer.writerow(row)
+                count += 1
+    return count
+
+
+def snapshot(path, conn=None):
+    """Make a consistent copy of the whole DB at `path`"""
+    if conn is None:
+        conn = connect_read_only()
+    output = sql.connect(path)
+    # Copy in one step. Copying in smaller steps restarts the copy every
+    # time the desk writes something, and in WAL mode our read lock doesn't
+    # hold up the desk anyway
+    conn.backup(output)
+    output.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("book", "books", "user", "users",
+                                                "loans", "snapshot"):
+        common.eprint(__doc__)
+        sys.exit(2)
+    if sys.argv[1] == "snapshot":
+        snapshot(sys.argv[2])
+        print(f"Saved snapshot to {sys.argv[2]}")
+    else:
+        print(f"Exported {export_table(sys.argv[1], sys.argv[2])} rows to {sys.argv[2]}")
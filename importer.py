@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  importer.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Bulk import of books and users for PyLibMan
+
+Usage:
+
+    python3 importer.py {books,users} FILE [CHUNK_SIZE]
+
+FILE can be CSV (with a header row naming the columns) or JSONL (one JSON
+object per line). Columns follow `db_struct_books`/`db_struct_users`.
+Anything other than `uid` and `name` can be left out and gets a sensible
+default. Users may also give `phone_numbers` and `emails` as comma-seperated
+columns instead of `contact_info`.
+
+Rows are streamed from the file and inserted in chunks, so files of any
+size can be imported in bounded memory. UIDs that repeat inside the file,
+or that are already in the DB, are reported and skipped.
+"""
+import sys
+import csv
+import json
+import time
+import common
+import db
+import schema
+
+
+# Columns stored as JSON, and their defaults when left out
+JSON_DEFAULTS = {"books": {"check_out_history": [],
+                           "check_in_status": common.get_template("status")},
+                 "users": {"contact_info": common.get_template("contact_info"),
+                           "checked_out_books": []}}
+
+
+def read_rows(path):
+    """Stream rows out of a CSV or JSONL file
+
+    Yields the line number each row started on, and the row as a dict, or
+    for JSONL, as the line of JSON. That's parsed by `normalize()`, so a bad
+    line only skips that row.
+    """
+    with open(path, "r", newline="") as file:
+        if path.lower().endswith((".jsonl", ".ndjson", ".json")):
+            for line_number, line in enumerate(file, 1):
+                if line.strip() == "":
+                    continue
+                yield line_number, line.strip()
+        else:
+            reader = csv.DictReader(file)
+            for row in reader:
+                yield reader.line_num, row
+
+
+def normalize(row, table):
+    """Convert a row from a file into a row for the DB
+
+    Raises ValueError if the row can't be used.
+    """
+    if isinstance(row, str):
+        row = json.loads(row)
+    output = common.get_template(table)
+    for each in output:
+        output[each] = row.get(each)
+    output["uid"] = int(output["uid"])
+    if output["name"] in (None, ""):
+        raise ValueError("Missing name")
+    if table == "books":
+        if output["published"] not in (None, ""):
+            output["published"] = int(output["published"])
+        else:
+            output["published"] = None
+    else:
+        if output["privs"] not in ("user", "admin"):
+            output["privs"] = "user"
+        if (output["contact_info"] in (None, "")) and (("phone_numbers" in row) or ("emails" in row)):
+            output["contact_info"] = common.get_template("contact_info")
+            for each in ("phone_numbers", "emails"):
+                if row.get(each) not in (None, ""):
+                    output["contact_info"][each] = row[each].split(",")
+    for column, default in JSON_DEFAULTS[table].items():
+        if output[column] in (None, ""):
+            output[column] = default
+        elif isinstance(output[column], str):
+            # CSV files hold JSON columns as text
+            output[column] = json.loads(output[column])
+    return output
+
+
+def __flush__(chunk, table, columns, conn, report):
+    """Insert a chunk of rows, reporting and skipping duplicate UIDs"""
+    with db.transaction(conn):
+        # Look the chunk's UIDs up with joins, as an IN list with one
+        # parameter per UID can go over SQLite's limit on parameters
+        conn.executemany("INSERT INTO temp.import_chunk VALUES (?)",
+                         [(each,) for each in chunk])
+        seen = {each[0] for each in conn.execute(
+            "SELECT uid FROM temp.import_chunk JOIN temp.import_seen USING (uid)")}
+        existing = {each[0] for each in conn.execute(
+            f"SELECT uid FROM temp.import_chunk JOIN {table} USING (uid)")}
+        rows = []
+        for uid, (line_number, row) in chunk.items():
+            if uid in seen:
+                print(f"Line {line_number}: UID {uid} appears earlier in the file. Skipping.")
+                report["duplicate_in_file"] += 1
+            elif uid in existing:
+                print(f"Line {line_number}: UID {uid} is already in the DB. Skipping.")
+                report["already_exists"] += 1
+            else:
+                rows.append([db.__bind__(row[each]) for each in columns])
+        conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})",
+                         rows)
+        conn.execute("INSERT OR IGNORE INTO temp.import_seen SELECT uid FROM temp.import_chunk")
+        conn.execute("DELETE FROM temp.import_chunk")
+        report["imported"] += len(rows)
+
+
+def import_file(path, table, chunk_size=1000, conn=None):
+    """Import books or users from a CSV or JSONL file
+
+    Returns a report of how many rows were imported, and how many were
+    skipped for each reason.
+    """
+    table = db.__table_name__(table)
+    if conn is None:
+        conn = db.connect()
+    schema.migrate(conn)
+    # Keep track of every UID in the file on disk, not in memory, so we can
+    # tell which duplicates came from the file itself
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS import_seen (uid INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM temp.import_seen")
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS import_chunk (uid INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM temp.import_chunk")
+    conn.commit()
+    columns = list(common.get_template(table))
+    report = {"imported": 0, "duplicate_in_file": 0, "already_exists": 0,
+              "invalid": 0}
+    chunk = {}
+    rows = 0
+    start = time.time()
+    for line_number, row in read_rows(path):
+        rows += 1
+        try:
+            row = normalize(row, table)
+        except (ValueError, TypeError, KeyError, AttributeError,
+                json.decoder.JSONDecodeError) as error:
+            print(f"Line {line_number}: Invalid row ({error}). Skipping.")
+            report["invalid"] += 1
+            continue
+        if row["uid"] in chunk:
+            print(f"Line {line_number}: UID {row['uid']} appears earlier in the file. Skipping.")
+            report["duplicate_in_file"] += 1
+            continue
+        chunk[row["uid"]] = (line_number, row)
+        if len(chunk) >= chunk_size:
+            __flush__(chunk, table, columns, conn, report)
+            chunk = {}
+            common.eprint(f"{rows} rows read, {report['imported']} imported ({rows / (time.time() - start):.0f} rows/sec)")
+    if chunk != {}:
+        __flush__(chunk, table, columns, conn, report)
+    conn.execute("DROP TABLE temp.import_seen")
+    conn.execute("DROP TABLE temp.import_chunk")
+    conn.commit()
+    common.eprint(f"{rows} rows read in {time.time() - start:.1f} seconds")
+    return report
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("book", "books", "user", "users"):
+        common.eprint(__doc__)
+        sys.exit(2)
+    if len(sys.argv) > 3:
+        REPORT = import_file(sys.argv[2], sys.argv[1], int(sys.argv[3]))
+    else:
+        REPORT = import_file(sys.argv[2], sys.argv[1])
+    print(f"""Imported: {REPORT['imported']}
+Skipped, UID repeated in file: {REPORT['duplicate_in_file']}
+Skipped, UID already in DB: {REPORT['already_exists']}
+Skipped, invalid: {REPORT['invalid']}""")
+    if REPORT["imported"] == 0:
+        sys.exit(1)
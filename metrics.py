@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Latency histograms and counters for the broker
+
+Every command the broker sends to a worker is counted by the table it was
+for and its `cmd_type`. Two times are kept for each:
+
+ * queue time: from the broker getting the request, to sending it to a
+   worker. This is time spent waiting behind other requests.
+ * worker time: from sending it to a worker, to getting the reply. This
+   covers the pipe both ways, and the worker doing the work, be it SQLite
+   or the webcam.
+
+Histograms have fixed, logarithmic buckets, so recording a time is a
+binary search and an increment no matter how many have been recorded.
+"""
+import bisect
+import json
+import os
+import time
+
+
+# Bucket upper bounds, in seconds. Four to every doubling, from 10
+# microseconds up to about 10 minutes.
+BOUNDS = tuple([0.00001 * (2 ** (each / 4)) for each in range(104)])
+
+
+class Histogram():
+    """Histogram of times, in seconds"""
+    def __init__(self):
+        """Make an empty histogram"""
+        # The last bucket is for anything past the last bound
+        self.buckets = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        """Add a time to the histogram"""
+        self.buckets[bisect.bisect_left(BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Estimate a percentile, as the upper bound of its bucket"""
+        if self.count == 0:
+            return 0.0
+        rank = self.count * percent / 100
+        seen = 0
+        for index, each in enumerate(self.buckets):
+            seen += each
+            if seen >= rank:
+                if index >= len(BOUNDS):
+                    return self.max
+                return min(BOUNDS[index], self.max)
+        return self.max
+
+    def summary(self):
+        """Summary of the histogram, in milliseconds"""
+        if self.count == 0:
+            mean = 0.0
+        else:
+            mean = self.total / self.count
+        return {"count": self.count,
+                "mean": mean * 1000,
+                "p50": self.percentile(50) * 1000,
+                "p95": self.percentile(95) * 1000,
+                "p99": self.percentile(99) * 1000,
+                "max": self.max * 1000}
+
+
+class CommandStats():
+    """Counters and histograms for one kind of command to one table"""
+    def __init__(self):
+        """Set up empty stats"""
+        self.queue = Histogram()
+        self.worker = Histogram()
+        self.timeouts = 0
+        self.failures = 0
+
+    def summary(self):
+        """Summary of the stats, with times in milliseconds"""
+        return {"count": self.worker.count,
+                "timeouts": self.timeouts,
+                "failures": self.failures,
+                "queue_ms": self.queue.summary(),
+                "worker_ms": self.worker.summary()}
+
+
+class Metrics():
+    """Stats for every kind of command the broker has seen"""
+    def __init__(self):
+        """Set up empty metrics"""
+        self.started = time.time()
+        self.commands = {}
+
+    def command(self, table, cmd_type):
+        """Get the stats for a kind of command to a table"""
+        key = (table, cmd_type)
+        if key not in self.commands:
+            self.commands[key] = CommandStats()
+        return self.commands[key]
+
+    def report(self):
+        """Summary of everything recorded so far"""
+        output = {"started": self.started,
+                  "now": time.time(),
+                  "commands": {}}
+        for (table, cmd_type), stats in sorted(self.commands.items()):
+            if table not in output["commands"]:
+                output["commands"][table] = {}
+            output["commands"][table][cmd_type] = stats.summary()
+        return output
+
+    def dump(self, path, extra=None):
+        """Write a report to a file as JSON
+
+        The file is replaced in one step, so anything reading it never sees
+        half a report.
+        """
+        report = self.report()
+        if extra is not None:
+            report.update(extra)
+        with open(f"{path}.tmp", "w") as file:
+            json.dump(report, file, indent=1)
+        os.replace(f"{path}.tmp", path)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  profiling.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Opt-in profiling of PyLibMan's processes
+
+Profiling is turned on for any process whose name (as given to
+`common.set_procname()`) matches one of the patterns in the `processes`
+list of the `profiling` setting, or given to `pylibman.py --profile`.
+Patterns are shell style, so `PLM-books-r*` covers every book reader, and
+`*` covers everything.
+
+There are two kinds of profiler, picked with the `mode` setting:
+
+ * `cprofile`: Python's deterministic profiler. Exact call counts, but it
+   slows the process down noticeably. Profiles are written as
+   `PROCNAME-PID.prof`, for `pstats` or `snakeviz`.
+ * `sample`: A thread that looks at what the process is doing every
+   `interval` seconds. Cheap enough to leave on under real desk load.
+   Profiles are written as `PROCNAME-PID.folded`, one stack per line with
+   how often it was seen, for `flamegraph.pl` or speedscope.
+
+Profiles are written to `directory` when the process exits, and whenever
+it gets SIGUSR1, without stopping the profiler.
+"""
+import cProfile
+import collections
+import fnmatch
+import os
+import signal
+import sys
+import threading
+import time
+from multiprocessing import util
+import common
+
+
+# The profiler running in this process, if any
+PROFILER = None
+
+
+def wanted(procname, patterns=None):
+    """Check if a process should be profiled"""
+    if patterns is None:
+        patterns = common.SETTINGS["profiling"]["processes"]
+    for each in patterns:
+        if fnmatch.fnmatchcase(procname, each):
+            return True
+    return False
+
+
+class SamplingProfiler():
+    """Profile the main thread by sampling its stack from another thread"""
+    def __init__(self, interval=0.005):
+        """Set up sampling every `interval` seconds"""
+        self.interval = interval
+        self.thread_id = threading.main_thread().ident
+        self.stacks = collections.Counter()
+        self.running = False
+        self.thread = None
+
+    def enable(self):
+        """Start sampling"""
+        self.running = True
+        self.thread = threading.Thread(target=self.__sample__, daemon=True,
+                                       name="PLM-profiler")
+        self.thread.start()
+
+    def disable(self):
+        """Stop sampling"""
+        self.running = False
+
+    def __sample__(self):
+        """Take samples until told to stop"""
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack != []:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def dump_stats(self, path):
+        """Write out the stacks seen so far, in collapsed stack format"""
+        with open(path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+def __path__(procname):
+    """Where to write the profile of this process"""
+    settings = common.SETTINGS["profiling"]
+    if settings["mode"] == "sample":
+        extension = "folded"
+    else:
+        extension = "prof"
+    return os.path.join(settings["directory"],
+                        f"{procname}-{os.getpid()}.{extension}")
+
+
+def dump(procname):
+    """Write out the profile of this process so far"""
+    if PROFILER is None:
+        return
+    path = __path__(procname)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if isinstance(PROFILER, cProfile.Profile):
+        # Stats can't be gathered while the profiler is running
+        PROFILER.disable()
+        PROFILER.dump_stats(path)
+        PROFILER.enable()
+    else:
+        PROFILER.dump_stats(path)
+    common.eprint(f"{procname}: wrote profile to {path}")
+
+
+def __forget__():
+    """Drop a profiler inherited from our parent, when forked"""
+    global PROFILER
+    if PROFILER is not None:
+        PROFILER.disable()
+        PROFILER = None
+
+
+os.register_at_fork(after_in_child=__forget__)
+
+
+def start(procname):
+    """Start profiling this process, if it's one we were asked to"""
+    global PROFILER
+    if (PROFILER is not None) or not wanted(procname):
+        return
+    settings = common.SETTINGS["profiling"]
+    if settings["mode"] == "sample":
+        PROFILER = SamplingProfiler(settings["interval"])
+    elif settings["mode"] == "cprofile":
+        PROFILER = cProfile.Profile()
+    else:
+        raise ValueError(f"Unknown profiling mode: '{settings['mode']}'")
+    PROFILER.enable()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: dump(procname))
+    # Make SIGTERM exit normally, so the profile gets written
+    if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Unlike `atexit`, this also runs when a `multiprocessing` child exits
+    util.Finalize(None, dump, args=(procname,), exitpriority=100)
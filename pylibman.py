@@ -24,16 +24,16 @@
 """Python Library Manager - Manage inventory, check in/out out books, track who has what book, and more!"""
 from __future__ import print_function
 import sys
-import cv2
-import sqlite3 as sql
 import json
 import time
 import multiprocessing
 import os
 import common
-import barcode
+import broker
 import db
-import ui
+import schema
+import tracing
+import wire
 
 
 
@@ -43,43 +43,58 @@ if sys.version_info[0] == 2:
 
 # Set up vars
 ARGC = len(sys.argv)
+if "--help" in sys.argv[1:] or "-h" in sys.argv[1:]:
+    print(common.HELP)
+    exit(0)
+# In server mode, we only run the DB workers and broker. Terminals attach to
+# the broker over its socket, and each scan codes with their own webcam.
+SERVER = "--server" in sys.argv[1:]
+if not SERVER:
+    # These need a webcam and a display, which a server may well not have
+    import barcode
+    import ui
+# Set these before starting anything, so every process sees them
+for flag, key in (("--profile", "processes"), ("--profile-mode", "mode")):
+    if flag in sys.argv[1:-1]:
+        value = sys.argv[sys.argv.index(flag) + 1]
+        if key == "processes":
+            value = value.split(",")
+        common.SETTINGS["profiling"][key] = value
+if "--trace" in sys.argv[1:]:
+    common.SETTINGS["tracing"]["enabled"] = True
+if common.SETTINGS["tracing"]["enabled"]:
+    tracing.reset()
 
 
-def qr_query(request, pipe_handle):
-    """Make a request from QR Code data"""
-    get = common.get_template("get")
-    get["filter"]["field"] = "uid"
-    get["filter"]["compare"] = request["uid"]
-    pipe_handle.send(get)
-    return pipe_handle.recv()
-
-
-# Initialize Webcam
-WEBCAM = cv2.VideoCapture(0)
-
-parent_conn, bar_pipe = multiprocessing.Pipe()
-parent_conn2, user_pipe = multiprocessing.Pipe()
-parent_conn3, book_pipe = multiprocessing.Pipe()
-parent_conn4, ui_pipe = multiprocessing.Pipe()
-procs = []
-procs.append(multiprocessing.Process(target=barcode.barcode_scanner,
-                                     args=(parent_conn, WEBCAM)))
-procs.append(multiprocessing.Process(target=db.book_table, args=(parent_conn3,)))
-procs.append(multiprocessing.Process(target=db.user_table, args=(parent_conn2,)))
-procs.append(multiprocessing.Process(target=ui.show, args=(parent_conn4,)))
-DB = sql.connect(common.SETTINGS["db_name"])
+DB = db.connect()
 tables = DB.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()
+schema.migrate(DB)
+DB.close()
+procs = []
+if SERVER:
+    bar_pipe = None
+    ui_pipe = None
+else:
+    process, bar_pipe = broker.start_worker(barcode.barcode_scanner)
+    procs.append(process)
+    process, ui_pipe = broker.start_worker(ui.show)
+    procs.append(process)
+process, book_pipe = broker.start_worker(db.book_table)
+procs.append(process)
+process, user_pipe = broker.start_worker(db.user_table)
+procs.append(process)
+# Read only workers, to take big reads off of each table's writer
+readers = {"users": [], "books": []}
+for table, pipes in readers.items():
+    for number in range(common.SETTINGS["read_workers"][table]):
+        process, reader_pipe = broker.start_worker(db.read_table, table, number)
+        procs.append(process)
+        pipes.append(reader_pipe)
+# Move any old checkout history into the loans table while we run
+procs.append(multiprocessing.Process(target=schema.backfill_loans))
+procs[-1].start()
 if len(tables) < 1:
-    print("Tables do not exist. Generating...")
-    DB.execute(f"CREATE TABLE users {db.get_struct('user')}")
-    DB.execute(f"CREATE TABLE books {db.get_struct('book')}")
-    DB.commit()
-    DB.close()
-    for each in procs:
-        each.start()
-    # give a second for everything to get going
-    sleep(0.1)
-    print("Adding temporary administrator account")
+    print("Tables did not exist. Adding temporary administrator account")
     add = common.get_template("add")
     add["data"] = common.get_template("db_users")
     add["data"]["uid"] = 1000
@@ -89,56 +104,21 @@ if len(tables) < 1:
     add["data"]["contact_info"]["emails"].append("test@example.com")
     add["data"]["checked_out_books"] = []
     add["data"]["privs"] = "admin"
-    user_pipe.send(add)
+    startup_pipe = wire.Channel(user_pipe)
+    startup_pipe.send(0, add)
+    startup_pipe.recv()
 else:
     print("Tables exist!")
 
-if len(tables) >= 1:
-    for each in procs:
-        each.start()
-
 common.set_procname("PLM-common")
-while True:
-    try:
-        if ui_pipe.poll():
-            ui_request = ui_pipe.recv()
-            if ui_request == "shut_down":
-                break
-            elif ui_request == "get_barcode":
-                while True:
-                    bar_pipe.send("get_barcode")
-                    data = bar_pipe.recv()
-                    if data["type"] in ("user", "users"):
-                        data = qr_query(data, user_pipe)
-                        break
-                    elif data["type"] in ("book", "books"):
-                        data = qr_query(data, book_pipe)
-                        break
-                    print(data)
-                ui_pipe.send(data)
-            elif isinstance(ui_request, dict):
-                if ui_request["table"] in ("user", "users"):
-                    user_pipe.send(ui_request["command"])
-                    ui_pipe.send(user_pipe.recv())
-                elif ui_request["table"] in ("book", "books"):
-                    book_pipe.send(ui_request["command"])
-                    ui_pipe.send(book_pipe.recv())
-                elif ui_request["table"] == "both":
-                    user_pipe.send(ui_request["command"])
-                    book_pipe.send(ui_request["command"])
-                    ui_pipe.send((user_pipe.recv(), book_pipe.recv()))
-                elif ui_request["table"] == "barcode":
-                    bar_pipe.send(ui_request["command"])
-                    ui_pipe.send(bar_pipe.recv())
-        else:
-            time.sleep(1)
-            continue
-    except KeyboardInterrupt:
-        print("Shutting down...")
-        break
+broker.broker(ui_pipe, bar_pipe, user_pipe, book_pipe, readers["users"],
+              readers["books"])
 # Shutdown and clean up
-WEBCAM.release()
+# Ask nicely first, so anything being profiled gets to write out its profile
 for each in procs:
-    each.kill()
     each.terminate()
-    each.join()
+for each in procs:
+    each.join(5)
+    if each.is_alive():
+        each.kill()
+        each.join()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  schema.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Schema and migrations for the PyLibMan DB"""
+import json
+import time
+import common
+import db as database
+
+
+# Numbered migrations, applied in order. Each one is a list of statements
+# that run inside a single transaction. NEVER edit a migration once it has
+# shipped, add a new one instead. The number of the last migration applied
+# to a DB is stored in its `user_version`.
+MIGRATIONS = [
+    # 1: The original tables, with no keys or indexes
+    (1, ["""CREATE TABLE IF NOT EXISTS users (uid INTEGER, name TEXT,
+                                              contact_info TEXT,
+                                              checked_out_books TEXT,
+                                              privs user)""",
+         """CREATE TABLE IF NOT EXISTS books (uid INTEGER, name TEXT,
+                                              check_out_history TEXT,
+                                              check_in_status TEXT,
+                                              published INTEGER)"""]),
+    # 2: Make `uid` the primary key of both tables. SQLite can't add a
+    # primary key to an existing table, so rebuild them. If a UID was
+    # somehow entered twice, the first entry wins, and the rest are moved
+    # to `users_duplicates` and `books_duplicates`, to be sorted out by hand.
+    (2, ["""CREATE TABLE users_duplicates AS
+                SELECT rowid AS original_rowid, * FROM users
+                WHERE uid IS NOT NULL AND rowid NOT IN (
+                    SELECT min(rowid) FROM users GROUP BY uid)""",
+         """CREATE TABLE users_new (uid INTEGER PRIMARY KEY, name TEXT,
+                                    contact_info TEXT,
+                                    checked_out_books TEXT, privs TEXT)""",
+         """INSERT OR IGNORE INTO users_new
+                SELECT uid, name, contact_info, checked_out_books, privs
+                FROM users ORDER BY rowid""",
+         "DROP TABLE users",
+         "ALTER TABLE users_new RENAME TO users",
+         """CREATE TABLE books_duplicates AS
+                SELECT rowid AS original_rowid, * FROM books
+                WHERE uid IS NOT NULL AND rowid NOT IN (
+                    SELECT min(rowid) FROM books GROUP BY uid)""",
+         """CREATE TABLE books_new (uid INTEGER PRIMARY KEY, name TEXT,
+                                    check_out_history TEXT,
+                                    check_in_status TEXT,
+                                    published INTEGER)""",
+         """INSERT OR IGNORE INTO books_new
+                SELECT uid, name, check_out_history, check_in_status,
+                       published
+                FROM books ORDER BY rowid""",
+         "DROP TABLE books",
+         "ALTER TABLE books_new RENAME TO books"]),
+    # 3: Titles are looked up by name when browsing the catalog
+    (3, ["CREATE INDEX IF NOT EXISTS books_name ON books (name)"]),
+    # 4: Checkout history moves out of the `check_out_history` JSON blob
+    # into its own append-only table. `returned_at` is NULL while a loan is
+    # open. Existing blobs are moved over by `backfill_loans()` in the
+    # background, or by the DB workers the first time they touch a book.
+    (4, ["""CREATE TABLE loans (id INTEGER PRIMARY KEY,
+                                book_uid INTEGER NOT NULL,
+                                user_uid INTEGER NOT NULL,
+                                checked_out REAL NOT NULL,
+                                due INTEGER NOT NULL,
+                                returned_at REAL)""",
+         "CREATE INDEX loans_book ON loans (book_uid, checked_out)",
+         "CREATE INDEX loans_user ON loans (user_uid, checked_out)",
+         # A book can only be checked out once at a time
+         """CREATE UNIQUE INDEX loans_open_book ON loans (book_uid)
+                WHERE returned_at IS NULL"""]),
+    # 5: What a user has checked out comes from their open loans, instead
+    # of the `checked_out_books` JSON list
+    (5, ["""CREATE INDEX loans_open_user ON loans (user_uid, checked_out)
+                WHERE returned_at IS NULL"""]),
+]
+VERSION = MIGRATIONS[-1][0]
+
+
+def __report_duplicates__(db):
+    """Say which entries migration 2 moved out of the way, if any"""
+    for table in ("users", "books"):
+        uids = [each[0] for each in db.execute(
+            f"SELECT DISTINCT uid FROM {table}_duplicates ORDER BY uid")]
+        if uids == []:
+            continue
+        count = db.execute(f"SELECT count(*) FROM {table}_duplicates").fetchone()[0]
+        shown = ", ".join([str(each) for each in uids[:20]])
+        if len(uids) > 20:
+            shown += f", and {len(uids) - 20} more"
+        common.eprint(f"WARNING: {count} entries in '{table}' had the same UID as an "
+                      f"earlier entry, and were moved to '{table}_duplicates'. "
+                      f"UIDs: {shown}")
+
+
+# Run after a migration, to report on what it did
+AFTER_MIGRATION = {2: __report_duplicates__}
+
+
+def get_version(db):
+    """Get the schema version of a DB"""
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db):
+    """Bring a DB up to the latest schema version
+
+    Returns the version the DB was at before migrating.
+    """
+    start = get_version(db)
+    for number, statements in MIGRATIONS:
+        if number <= start:
+            continue
+        print(f"Migrating DB to schema version {number}...")
+        db.execute("BEGIN")
+        try:
+            for each in statements:
+                db.execute(each)
+            # PRAGMA doesn't take parameters. `number` is always an int
+            db.execute(f"PRAGMA user_version = {int(number)}")
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        if number in AFTER_MIGRATION:
+            AFTER_MIGRATION[number](db)
+    return start
+
+
+def backfill_loans(path=None, batch=200, pause=0.05):
+    """Move every book's JSON checkout history into the `loans` table
+
+    This works through the catalog in small batches, one transaction each,
+    so it can run in the background while the desk is in use. It is safe to
+    stop at any point and start again later.
+    """
+    common.set_procname("PLM-migrate")
+    if path is None:
+        path = common.SETTINGS["db_name"]
+    db = database.connect(path)
+    last_uid = None
+    moved = 0
+    while True:
+        db.execute("BEGIN IMMEDIATE")
+        if last_uid is None:
+            rows = db.execute("""SELECT uid, check_out_history, check_in_status
+                                 FROM books ORDER BY uid LIMIT ?""",
+                              (batch,)).fetchall()
+        else:
+            rows = db.execute("""SELECT uid, check_out_history, check_in_status
+                                 FROM books WHERE uid > ? ORDER BY uid LIMIT ?""",
+                              (last_uid, batch)).fetchall()
+        for uid, history, status in rows:
+            if history in (None, "", "[]"):
+                continue
+            database.move_history(db, uid, json.loads(history),
+                                  json.loads(status))
+            moved += 1
+        db.commit()
+        if len(rows) < batch:
+            break
+        last_uid = rows[-1][0]
+        # Give the DB workers a chance at the write lock
+        time.sleep(pause)
+    db.close()
+    if moved > 0:
+        print(f"Moved checkout history of {moved} books into loans table")
+    return moved
+
+
+if __name__ == "__main__":
+    DB = database.connect()
+    print(f"Schema version {migrate(DB)} -> {get_version(DB)}")
+    DB.close()
+    backfill_loans()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  tracing.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""End to end tracing of requests
+
+When the `tracing` setting is enabled, every request sent through a
+`wire.RequestPipe` gets a trace ID, carried in its command dict as
+`trace`. Each process it passes through records a span for its part:
+
+ * the client (the UI, or a terminal): from sending the request to
+   getting the reply
+ * the broker: from getting the request to sending on the reply, and
+   within that, time queued and time with the worker
+ * the worker: running the command, be it the DB or the scanner
+
+Spans are appended to the file named in the setting, in the Chrome trace
+event format, which chrome://tracing and https://ui.perfetto.dev can open.
+The spans of a request are linked by flow arrows, and every span has the
+trace ID in its args, so one scan or checkout can be followed across all
+of the processes. Timestamps come from the system wide monotonic clock,
+so spans from different processes line up.
+"""
+import itertools
+import json
+import os
+import time
+import common
+
+
+# File descriptor of the trace file, opened on first use
+FD = None
+IDS = None
+
+
+def enabled():
+    """Check if tracing is on"""
+    return common.SETTINGS["tracing"]["enabled"]
+
+
+def now():
+    """Current time, in microseconds, in the form spans take"""
+    return time.monotonic_ns() // 1000
+
+
+def reset(path=None):
+    """Start a fresh trace file
+
+    Run this once before starting any of the processes, rather than in
+    each of them.
+    """
+    if path is None:
+        path = common.SETTINGS["tracing"]["path"]
+    with open(path, "w") as file:
+        # The closing bracket is optional in this format, which lets every
+        # process just append to the file
+        file.write("[\n")
+
+
+def __write__(*events):
+    """Append events to the trace file"""
+    global FD
+    if FD is None:
+        FD = os.open(common.SETTINGS["tracing"]["path"],
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    # One write per call, so lines from different processes don't mix
+    os.write(FD, "".join([json.dumps(each) + ",\n" for each in events]).encode())
+
+
+def start(procname):
+    """Name this process in the trace"""
+    if enabled():
+        __write__({"ph": "M", "name": "process_name", "pid": os.getpid(),
+                   "tid": 0, "args": {"name": procname}})
+
+
+def new_trace():
+    """Make a trace ID, unique across every process"""
+    global IDS
+    if (IDS is None) or (IDS[0] != os.getpid()):
+        IDS = (os.getpid(), itertools.count(1))
+    return (IDS[0] << 24) + next(IDS[1])
+
+
+def trace_of(command):
+    """Get the trace ID of a command, or None if it doesn't have one"""
+    if isinstance(command, dict):
+        return command.get("trace")
+    return None
+
+
+def name_of(command):
+    """Short name of a command, for naming spans"""
+    if isinstance(command, dict):
+        return str(command.get("cmd_type"))
+    return str(command)
+
+
+def span(name, trace, start, end=None, flow=None, args=None, tid=0):
+    """Record a span, with times from `now()`
+
+    `flow` links the span to the others in its trace: "s" for the first,
+    "t" for any in the middle, and "f" for the last. Spans on the same
+    `tid` have to nest, so processes handling several requests at once
+    should give each trace its own.
+    """
+    if end is None:
+        end = now()
+    event_args = {"trace": trace}
+    if args is not None:
+        event_args.update(args)
+    events = [{"ph": "X", "name": name, "cat": "plm", "ts": start,
+               "dur": max(end - start, 0), "pid": os.getpid(), "tid": tid,
+               "args": event_args}]
+    if flow is not None:
+        events.append({"ph": flow, "name": "request", "cat": "plm",
+                       "id": trace, "ts": start, "pid": os.getpid(),
+                       "tid": tid, "bp": "e"})
+    __write__(*events)
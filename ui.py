@@ -26,6 +26,8 @@ import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
 import common
+import wire
+import catalog
 import time
 import random
 
@@ -42,6 +44,8 @@ class PyLibMan_UI(Gtk.Window):
 
         # Make sure the whole class can access the pipe to the main thread
         self.pipe = pipe
+        # Catalog snapshot published by the book table, for read-only screens
+        self.catalog = catalog.CatalogReader()
         # Make user data available class-wide
         self.user = None
         # Make our tabs
@@ -328,11 +332,14 @@ Files are stored At:
         self.keys = {"enter": self.view_books_ui,
                      "esc": self.reset}
 
-        cmd = common.get_template("get")
-        cmd["column"] = "name"
-        del cmd["filter"]
-        cmd = {"table": "book", "command": cmd}
-        self.pipe.send(cmd)
+        # Read titles straight from the catalog snapshot if we can
+        from_snapshot = self.catalog.refresh()
+        if not from_snapshot:
+            cmd = common.get_template("get")
+            cmd["column"] = "name"
+            del cmd["filter"]
+            cmd = {"table": "book", "command": cmd}
+            self.pipe.send(cmd)
 
         # While those threads are working, we can get our UI made
         label = Gtk.Label()
@@ -362,13 +369,17 @@ Files are stored At:
         button = self._set_default_margins(button)
         self.grid.attach(button, 2, 4, 1, 1)
 
-        # NOW get our data out of the pipe
-        data = self.pipe.recv()
-        # make sure the data is a sorted list of unique entries
-        if isinstance(data, tuple):
-            data = list(data)
-        data = common.unique(data)
-        data.sort()
+        if from_snapshot:
+            # Already a sorted list of unique entries
+            data = self.catalog.titles()
+        else:
+            # NOW get our data out of the pipe
+            data = self.pipe.recv()
+            # make sure the data is a sorted list of unique entries
+            if isinstance(data, tuple):
+                data = list(data)
+            data = common.unique(data)
+            data.sort()
 
         # add them to the drop down box
         for each in data:
@@ -527,7 +538,7 @@ Files are stored At:
                     details = each
             except AttributeError:
                 pass
-        response = self.pipe.recv()[1]
+        response = self.pipe.recv()
         if isinstance(response, (int, float)):
             due_date = time.ctime(response)
             details.set_markup(f"Your book is due back by: {due_date}")
@@ -558,7 +569,7 @@ Files are stored At:
             if "<class 'gi.overrides.Gtk.Label'>" == str(type(each)):
                 element.append(each)
         for each in element:
-            if ((each.get_text() == "----") or ("uid" in each.get_text()) or (each.get_text() in ("Book Not Found", "Not a Book", "An Error has occured")) or ("due back by" in each.get_text())):
+            if ((each.get_text() == "----") or ("uid" in each.get_text()) or (each.get_text() in ("Book Not Found", "Not a Book", "An Error has occured", "Already Checked In", "Renewal Limit Reached", "Checked Out to Someone Else")) or ("due back by" in each.get_text())):
                 details = each
             elif (("Waiting for Book..." in each.get_text()) or ("Book Found" in each.get_text()) or ("Renewed" in each.get_text())):
                 status = each
@@ -614,11 +625,11 @@ Files are stored At:
             try:
                 if (("Waiting for Book..." in each.get_text()) or ("Book Found" in each.get_text()) or ("Renewed" in each.get_text())):
                     status = each
-                elif ((each.get_text() == "----") or ("uid" in each.get_text()) or (each.get_text() in ("Book Not Found", "Not a Book", "An Error has occured")) or ("due back by" in each.get_text()) or ("Already Checked In" in each.get_text())):
+                elif ((each.get_text() == "----") or ("uid" in each.get_text()) or (each.get_text() in ("Book Not Found", "Not a Book", "An Error has occured")) or ("due back by" in each.get_text()) or (each.get_text() in ("Already Checked In", "Renewal Limit Reached", "Checked Out to Someone Else"))):
                     details = each
             except AttributeError:
                 pass
-        response = self.pipe.recv()[1]
+        response = self.pipe.recv()
         if isinstance(response, (int, float)):
             due_date = time.ctime(response)
             details.set_markup(f"Your book is due back by: {due_date}")
@@ -629,7 +640,12 @@ Files are stored At:
                 status.set_markup("Waiting for Book...")
             if response["status"] == 2:
                 status.set_markup("Book Found")
-                details.set_markup("Already Checked In")
+                if response["reason"] == "renewal_limit":
+                    details.set_markup("Renewal Limit Reached")
+                elif response["reason"] == "checked_out":
+                    details.set_markup("Checked Out to Someone Else")
+                else:
+                    details.set_markup("Already Checked In")
         self.page2.remove(button)
         self.show_all()
 
@@ -703,7 +719,7 @@ Files are stored At:
                     details = each
             except AttributeError:
                 pass
-        response = self.pipe.recv()[1]
+        response = self.pipe.recv()
         if response["status"] == 1:
             details.set_markup("----")
             status.set_markup("Book Successfully Checked Back In")
@@ -967,10 +983,7 @@ Exiting now will cause any unsaved data to be lost.""")
                     db_struct["published"] = int(each.get_text())
 
         # we have retreived data from the UI. Generate remaining data
-        db_struct["check_in_status"] = {"status": "checked_in",
-                                        "possession": None,
-                                        "duration": 0,
-                                        "due_date": 0}
+        db_struct["check_in_status"] = common.get_template("status")
         db_struct["check_out_history"] = []
 
         # Generate command
@@ -1014,17 +1027,21 @@ Exiting now will cause any unsaved data to be lost.""")
                 if each.get_placeholder_text() == "UID (Unique ID)":
                     placement = each
                     break
-        cmd = common.get_template("get")
-        cmd["column"] = "uid"
-        del cmd["filter"]
-        cmd = {"table": "book", "command": cmd}
-        self.pipe.send(cmd)
-        data = self.pipe.recv()
+        if self.catalog.refresh():
+            taken = self.catalog.has_uid
+        else:
+            cmd = common.get_template("get")
+            cmd["column"] = "uid"
+            del cmd["filter"]
+            cmd = {"table": "book", "command": cmd}
+            self.pipe.send(cmd)
+            data = self.pipe.recv()
+            taken = lambda uid: uid in data
         print("Generating UID...")
         while True:
             uid = random.randint(100000000, 999999999)
             print("Selecting UID: ", uid)
-            if uid not in data:
+            if not taken(uid):
                 break
             print("UID already taken. Retrying")
         placement.set_text(str(uid))
@@ -1469,7 +1486,7 @@ Exiting now will cause any unsaved data to be lost.""")
 def show(pipe):
     """Show Main UI"""
     common.set_procname("PLM-UI")
-    window = PyLibMan_UI(pipe)
+    window = PyLibMan_UI(wire.RequestPipe(pipe))
     window.set_decorated(True)
     window.set_resizable(False)
     window.connect("delete-event", PyLibMan_UI._exit)
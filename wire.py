@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  wire.py
+#
+#  Copyright 2021 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Messaging between PyLibMan's processes
+
+Every message starts with the ID of the request it belongs to, in a fixed
+8 byte header. How the body after it is encoded depends on the
+`wire_format` setting:
+
+ * `pickle` (the default): The body is pickled as is. This is the fastest
+   to encode and decode.
+ * `compact`: A small binary format that knows the shapes of our commands
+   and DB rows. Any dict shaped like one of the templates in `common` is
+   sent as just its values, and lists of them (like the rows from a `get`)
+   are sent column by column. The result is serialized with `marshal`.
+   Messages come out 20-45% smaller, but take longer to encode and decode,
+   so this only pays off where bytes are what is expensive, like clients
+   attached over a slow link. It also ties every process to the same
+   version of Python.
+
+Either way, the broker doesn't need to look inside most replies, so it
+passes them on still encoded, using `recv_raw()` and `send_raw()`.
+
+`StreamChannel` is the same thing for asyncio streams. It uses the same
+framing as `multiprocessing` connections, so a `Channel` at one end of a
+pipe or socket can talk to a `StreamChannel` at the other.
+
+Clients attaching to the broker over a socket may have to prove they know
+a shared key first. The broker sends a random challenge, which the client
+answers with an HMAC of it, keyed with the shared key.
+"""
+import asyncio
+import collections
+import functools
+import hmac
+import itertools
+import marshal
+import multiprocessing
+import operator
+import os
+import pickle
+import socket
+import struct
+import common
+import tracing
+
+
+# Everything other than a scalar, or a list holding only scalars, is
+# encoded as a tuple starting with one of these tags. Real tuples get
+# tagged too. That way the decoder can hand back any bare list as is.
+TUPLE = 0
+RECORD = 1
+ROWS = 2
+LISTS = 3
+LIST = 4
+DICT = 5
+
+SCALARS = frozenset((type(None), bool, int, float, str, bytes))
+HEADER = struct.Struct("<q")
+# Framing used by `multiprocessing.connection.Connection`
+FRAME = struct.Struct("!i")
+LARGE_FRAME = struct.Struct("!Q")
+CHALLENGE_SIZE = 32
+WELCOME = b"#WELCOME#"
+FAILURE = b"#FAILURE#"
+
+
+def __gather_schemas__():
+    """Get the key layout of every dict shape we know about"""
+    output = []
+
+    def gather(template):
+        if isinstance(template, dict):
+            keys = tuple(template)
+            if keys not in output:
+                output.append(keys)
+            for each in template.values():
+                gather(each)
+
+    # The order here has to be the same in every process, so NEVER change
+    # it based on anything outside this file
+    for each in ("db_books", "db_users", "status", "contact_info",
+                 "check_out_history", "get", "check_out", "check_in",
+                 "renew", "change", "delete", "add", "make_qr", "print_qr",
+                 "batch"):
+        gather(common.get_template(each))
+    for each in (("cmd_type", "column"), # `get` with no filter
+                 ("table", "command"), # requests from the UI
+                 ("type", "uid"), # scanned QR codes
+                 ("status",), ("status", "reason"),
+                 ("status", "reason", "user"), # replies
+                 ("cmd_type",)): # `get_barcode`, when traced
+        if each not in output:
+            output.append(each)
+    # Commands again, carrying a trace ID
+    for each in list(output):
+        if each[0] == "cmd_type":
+            output.append(each + ("trace",))
+    return output
+
+
+SCHEMAS = __gather_schemas__()
+SCHEMA_INDEX = {keys: index for index, keys in enumerate(SCHEMAS)}
+
+
+def __encode__(value):
+    """Convert a message into something `marshal` can serialize"""
+    kind = type(value)
+    if kind in SCALARS:
+        return value
+    if kind is dict:
+        index = SCHEMA_INDEX.get(tuple(value))
+        if index is not None:
+            return (RECORD, index) + tuple([__encode__(each) for each in value.values()])
+        return (DICT, {key: __encode__(each) for key, each in value.items()})
+    if kind is list:
+        return __encode_list__(value)
+    if kind is tuple:
+        return (TUPLE,) + tuple([__encode__(each) for each in value])
+    raise TypeError(f"Can't encode {kind.__name__} for sending")
+
+
+def __encode_list__(value):
+    """Encode a list, skipping the work if it only holds scalars"""
+    if all(map(SCALARS.__contains__, map(type, value))):
+        return value
+    if type(value[0]) is dict:
+        keys = tuple(value[0])
+        index = SCHEMA_INDEX.get(keys)
+        if ((index is not None) and
+                all(map(isinstance, value, itertools.repeat(dict))) and
+                all(map(keys.__eq__, map(tuple, value)))):
+            # Rows of a known shape go column by column
+            columns = [__encode_list__(list(map(operator.itemgetter(key), value)))
+                       for key in keys]
+            return (ROWS, index) + tuple(columns)
+    elif all(map(isinstance, value, itertools.repeat(list))):
+        # A list of lists (like the checkout history column of some rows)
+        # gets flattened, so its contents can be encoded in one go
+        return (LISTS, list(map(len, value)),
+                __encode_list__(list(itertools.chain.from_iterable(value))))
+    return (LIST, [__encode__(each) for each in value])
+
+
+def __decode__(value):
+    """Convert something made by `__encode__()` back to a message"""
+    if type(value) is not tuple:
+        # Scalars, and lists of them, are sent as is
+        return value
+    if value[0] == ROWS:
+        keys = SCHEMAS[value[1]]
+        columns = [__decode__(each) for each in value[2:]]
+        return list(map(dict, map(zip, itertools.repeat(keys), zip(*columns))))
+    if value[0] == RECORD:
+        return dict(zip(SCHEMAS[value[1]],
+                        [__decode__(each) for each in value[2:]]))
+    if value[0] == LISTS:
+        items = __decode__(value[2])
+        ends = list(itertools.accumulate(value[1]))
+        return [items[start:end] for start, end in zip([0] + ends, ends)]
+    if value[0] == LIST:
+        return [__decode__(each) for each in value[1]]
+    if value[0] == DICT:
+        return {key: __decode__(each) for key, each in value[1].items()}
+    return tuple([__decode__(each) for each in value[1:]])
+
+
+def encode(body):
+    """Encode a message body to bytes"""
+    return marshal.dumps(__encode__(body))
+
+
+def decode(payload):
+    """Decode a message body from bytes"""
+    return __decode__(marshal.loads(payload))
+
+
+def __codec__(wire_format):
+    """Get the functions to encode and decode bodies in a wire format"""
+    if wire_format is None:
+        wire_format = common.SETTINGS["wire_format"]
+    if wire_format == "pickle":
+        return (functools.partial(pickle.dumps, protocol=pickle.HIGHEST_PROTOCOL),
+                pickle.loads)
+    if wire_format == "compact":
+        return encode, decode
+    raise ValueError(f"Unknown wire format: '{wire_format}'")
+
+
+def __digest__(authkey, challenge):
+    """Answer to a challenge"""
+    return hmac.new(authkey, challenge, "sha256").digest()
+
+
+def answer_challenge(conn, authkey):
+    """Prove to the broker that we know the shared key
+
+    `conn` is a plain `multiprocessing` connection, before it is wrapped in
+    a `Channel`. Raises `multiprocessing.AuthenticationError` if the broker
+    turns us away.
+    """
+    conn.send_bytes(__digest__(authkey, conn.recv_bytes(CHALLENGE_SIZE)))
+    if conn.recv_bytes(len(WELCOME)) != WELCOME:
+        raise multiprocessing.AuthenticationError("Broker refused the shared key")
+
+
+class Channel():
+    """One end of a pipe between two of our processes
+
+    This has `poll()` and `fileno()`, so it can be waited on just like the
+    pipe it wraps.
+    """
+    def __init__(self, conn, wire_format=None):
+        """Wrap a connection"""
+        self.conn = conn
+        self.encode, self.decode = __codec__(wire_format)
+
+    def fileno(self):
+        """File descriptor of the underlying connection"""
+        return self.conn.fileno()
+
+    def poll(self, timeout=0.0):
+        """Check if there is anything to receive"""
+        return self.conn.poll(timeout)
+
+    def close(self):
+        """Close the underlying connection"""
+        self.conn.close()
+
+    def send_raw(self, request_id, payload):
+        """Send a payload exactly as received from `recv_raw()`"""
+        self.conn.send_bytes(HEADER.pack(request_id) + payload)
+
+    def recv_raw(self):
+        """Receive a request ID, and a payload that hasn't been decoded yet
+
+        The payload can be passed to `decode_raw()`, or sent on as is with
+        `send_raw()`.
+        """
+        frame = self.conn.recv_bytes()
+        return HEADER.unpack_from(frame)[0], frame[HEADER.size:]
+
+    def decode_raw(self, payload):
+        """Decode a payload from `recv_raw()`"""
+        return self.decode(payload)
+
+    def send(self, request_id, body):
+        """Send a message"""
+        self.send_raw(request_id, self.encode(body))
+
+    def recv(self):
+        """Receive a message, as a request ID and a body"""
+        request_id, payload = self.recv_raw()
+        return request_id, self.decode_raw(payload)
+
+
+class StreamChannel():
+    """One end of a pipe or socket, for use from asyncio
+
+    Works just like `Channel`, except sending and receiving are coroutines.
+    Sending waits for the other end to catch up once enough is buffered,
+    so a peer that isn't reading can't make us buffer without limit.
+    """
+    def __init__(self, reader, writer, wire_format=None):
+        """Wrap a pair of asyncio streams"""
+        self.reader = reader
+        self.writer = writer
+        self.encode, self.decode = __codec__(wire_format)
+
+    @classmethod
+    async def from_connection(cls, conn, wire_format=None):
+        """Take over a `multiprocessing` connection
+
+        The connection must be one end of a duplex pipe, which are Unix
+        sockets under the hood. It gets closed, with the stream taking its
+        place.
+        """
+        sock = socket.socket(fileno=os.dup(conn.fileno()))
+        conn.close()
+        reader, writer = await asyncio.open_unix_connection(sock=sock)
+        return cls(reader, writer, wire_format)
+
+    def close(self):
+        """Close the underlying stream"""
+        self.writer.close()
+
+    def __write_frame__(self, frame):
+        """Write one frame, without waiting for it to be sent"""
+        if len(frame) > 0x7fffffff:
+            self.writer.write(FRAME.pack(-1) + LARGE_FRAME.pack(len(frame)))
+        else:
+            self.writer.write(FRAME.pack(len(frame)))
+        self.writer.write(frame)
+
+    def write_raw(self, request_id, payload):
+        """Queue up a payload exactly as received from `recv_raw()`
+
+        This doesn't wait on the other end, so use it only where something
+        else is limiting how much gets queued up.
+        """
+        self.__write_frame__(HEADER.pack(request_id) + payload)
+
+    async def send_raw(self, request_id, payload):
+        """Send a payload exactly as received from `recv_raw()`"""
+        self.write_raw(request_id, payload)
+        await self.writer.drain()
+
+    async def __read_frame__(self, limit=None):
+        """Read one frame, refusing any bigger than `limit`"""
+        try:
+            size = FRAME.unpack(await self.reader.readexactly(FRAME.size))[0]
+            if size == -1:
+                size = LARGE_FRAME.unpack(await self.reader.readexactly(LARGE_FRAME.size))[0]
+            if (limit is not None) and (size > limit):
+                raise EOFError("Frame too big")
+            return await self.reader.readexactly(size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            raise EOFError("Connection closed") from None
+
+    async def challenge(self, authkey):
+        """Check that the client at the other end knows the shared key
+
+        Returns whether it does. Clients that don't are told so, but it is
+        up to the caller to hang up on them.
+        """
+        challenge = os.urandom(CHALLENGE_SIZE)
+        self.__write_frame__(challenge)
+        await self.writer.drain()
+        try:
+            answer = await self.__read_frame__(len(challenge) * 2)
+        except EOFError:
+            return False
+        if hmac.compare_digest(answer, __digest__(authkey, challenge)):
+            self.__write_frame__(WELCOME)
+            return True
+        self.__write_frame__(FAILURE)
+        return False
+
+    async def recv_raw(self):
+        """Receive a request ID, and a payload that hasn't been decoded yet
+
+        Raises `EOFError` once the other end has hung up.
+        """
+        frame = await self.__read_frame__()
+        return HEADER.unpack_from(frame)[0], frame[HEADER.size:]
+
+    def decode_raw(self, payload):
+        """Decode a payload from `recv_raw()`"""
+        return self.decode(payload)
+
+    def encode_raw(self, body):
+        """Encode a body into a payload, for `send_raw()`"""
+        return self.encode(body)
+
+    async def send(self, request_id, body):
+        """Send a message"""
+        await self.send_raw(request_id, self.encode(body))
+
+    async def recv(self):
+        """Receive a message, as a request ID and a body"""
+        request_id, payload = await self.recv_raw()
+        return request_id, self.decode_raw(payload)
+
+
+class RequestPipe():
+    """Pipe that tags every request with an ID, and matches up the replies
+
+    Replies may come back in a different order than the requests went out.
+    `recv()` gives the reply to the oldest request still waiting on one,
+    holding on to any others that arrive first, so callers can keep
+    treating this like a plain pipe.
+
+    If tracing is on, every request gets a trace ID, and a span from it
+    being sent to its reply being received.
+    """
+    def __init__(self, pipe):
+        """Wrap a pipe to the broker"""
+        self.pipe = Channel(pipe)
+        self.next_id = 0
+        self.waiting = collections.deque()
+        self.replies = {}
+        # Trace ID, span name, and start of each traced request, by ID
+        self.traces = {}
+
+    def __trace__(self, body):
+        """Give a request a trace ID"""
+        trace = tracing.new_trace()
+        if body == "get_barcode":
+            # A plain string can't carry a trace ID
+            body = {"table": "barcode",
+                    "command": {"cmd_type": "get_barcode", "trace": trace}}
+        elif isinstance(body, dict) and isinstance(body.get("command"), dict):
+            body = dict(body)
+            body["command"] = dict(body["command"])
+            body["command"]["trace"] = trace
+        else:
+            return body
+        self.traces[self.next_id] = (trace,
+                                     f"{body['table']} {tracing.name_of(body['command'])}",
+                                     tracing.now())
+        return body
+
+    def send(self, body):
+        """Send a request, returning its ID"""
+        self.next_id += 1
+        if tracing.enabled() and body != "shut_down":
+            body = self.__trace__(body)
+        self.pipe.send(self.next_id, body)
+        if body != "shut_down":
+            self.waiting.append(self.next_id)
+        return self.next_id
+
+    def recv(self, request_id=None):
+        """Get the reply to a request
+
+        By default, this is the oldest request still waiting on a reply.
+        """
+        if request_id is None:
+            request_id = self.waiting[0]
+        while request_id not in self.replies:
+            reply_id, body = self.pipe.recv()
+            self.replies[reply_id] = body
+            if reply_id in self.traces:
+                trace, name, start = self.traces.pop(reply_id)
+                tracing.span(name, trace, start, flow="s", tid=trace)
+        self.waiting.remove(request_id)
+        return self.replies.pop(request_id)